@@ -2,10 +2,16 @@ __author__ = 'Brian'
 from webapp2 import WSGIApplication
 from google.appengine.ext import db
 from converter import DictionaryConverter
+import converter
+from cache import LRUCache
+import jsoncodec
+from timing import TimingStats
+import profiling
 import handlers
 import errors
 import logging
 import importlib
+import hashlib
 from types import ModuleType
 import os
 
@@ -15,12 +21,64 @@ class JSONApplication(WSGIApplication):
     Parameters:
         auth_func: function that takes a WebOb.request
         Should raise errors.AuthenticationRequiredException or errors.AuthenticationFailedException appropriately.
+
+        fragment_cache: optional cache.FragmentCache used to serve model reads
+            and search pages from already-encoded model JSON.
+            Writes made through the API invalidate the fragments of the models
+            they change. Writes made any other way are not seen until the
+            fragments expire (after the cache's time, 10 minutes by default).
+
+        json_codec: optional jsoncodec.JsonCodec used to encode and decode JSON.
+            Defaults to the fastest one installed (see jsoncodec.best_available_codec).
+
+        gzip_level: zlib compression level (1-9) used to gzip responses for
+            clients sending "Accept-Encoding: gzip". None disables compression.
+
+        gzip_min_size: responses smaller than this many bytes are not compressed.
+            Streamed responses (export) are always compressed when negotiated.
+
+        auth_cache: optional cache.AuthCache remembering auth_func decisions.
+            Call auth_cache.invalidate() when credentials change.
+
+        max_page_size: largest search page served. Larger limits are reduced to
+            it, and it is returned with every search page as "max_limit" so that
+            clients sizing their pages adaptively know how far they may grow.
+
+        timing: when True, every response carries a Server-Timing header breaking
+            the request down into auth, datastore, convert, decode, encode and
+            gzip time, and timings are aggregated per route and model into
+            histograms served (to authenticated callers) by GET /prefix/_stats.
+            Requests for unregistered models, and those failing authentication,
+            are recorded without a model.
+
+        profile_policy: optional profiling.ProfilePolicy choosing requests to run
+            under cProfile (at random, on "?_profile=1", or by a function of the
+            request) and reporting their slowest functions.
+
+        search_budget: default time budget, in seconds, of searches. A search
+            running out of budget returns the models read so far, marked
+            "partial", with a cursor to continue from. None (the default) means
+            searches always return full pages. See SearchHandler.
+
+        query_cache: optional cache.QueryCache remembering the keys of search
+            result pages. Writes made through the API invalidate the pages of
+            their model; writes made elsewhere are not seen until pages expire
+            (after the cache's time, 10 minutes by default).
     """
-    def __init__(self, prefix, auth_func=None, require_https=False, models=None, model_modules=None, debug=False, config=None):
+    # Number of hosts whose encoded model list is kept (it contains absolute URLs).
+    MAX_MODEL_LIST_DOCUMENTS = 16
+
+    def __init__(self, prefix, auth_func=None, require_https=False, models=None, model_modules=None, debug=False, config=None,
+                 fragment_cache=None, json_codec=None, gzip_level=None, gzip_min_size=1024,
+                 auth_cache=None, max_page_size=1000, timing=False, profile_policy=None,
+                 search_budget=None, query_cache=None):
         routes = [
+            ('/%s/_stats' % prefix, handlers.StatsHandler),
             ('/%s/metadata/?' % prefix, handlers.MetadataHandler),
             ('/%s/([^/]+)/metadata' % prefix, handlers.MetadataHandler),
             ('/%s/([^/]+)/search' % prefix, handlers.SearchHandler),
+            ('/%s/([^/]+)/export' % prefix, handlers.ExportHandler),
+            ('/%s/([^/]+)/batch' % prefix, handlers.BatchHandler),
             ('/%s/([^/]+)/?' % prefix, handlers.SingleModelHandler),
             ('/%s/([^/]+)/([^/]+)/?' % prefix, handlers.SingleModelHandler),
         ]
@@ -28,10 +86,28 @@ class JSONApplication(WSGIApplication):
         super(JSONApplication, self).__init__(routes, debug, config)
         self.require_https = require_https
         self.authenticator = auth_func
+        self.auth_cache = auth_cache
+        self.fragment_cache = fragment_cache
+        self.json_codec = json_codec or jsoncodec.best_available_codec()
+        logging.debug("Using JSON codec '{0}'".format(self.json_codec.name))
+        self.gzip_level = gzip_level
+        self.gzip_min_size = gzip_min_size
+        self.max_page_size = max_page_size
+        self.search_budget = search_budget
+        self.query_cache = query_cache
+        self.timing_stats = None
+        if timing:
+            self.timing_stats = TimingStats()
+        self.profile_policy = profile_policy
+        if profile_policy:
+            profiling.install(self, profile_policy)
         self.__models_by_name = {}
         self.__models_by_type = {}
         self.__property_converters = {}
         self.__api_path = "/{0}".format(prefix)
+        self.__metadata_documents = {}
+        self.__model_list_documents = LRUCache(max_bytes=None, max_items=self.MAX_MODEL_LIST_DOCUMENTS)
+        self.__metadata_generation = converter.converters_generation
         self.converter = DictionaryConverter(self)
 
         if models:
@@ -82,6 +158,11 @@ class JSONApplication(WSGIApplication):
                 raise KeyError('Model with name {0} already registered'.format(model_name))
             self.__models_by_name[model_name] = model
             self.__models_by_type[model] = model_name
+            # Back-reference URLs in cached serialization plans depend on registered names.
+            self.converter.clear_plans()
+            # The model list changed, so only per-model metadata documents stay valid.
+            self.__model_list_documents.flush_all()
+            self.__metadata_documents[model_name] = self.__encode_success(self.converter.metadata(model))
 
     def register_models_from_module(self, model_module, prefix_with_package_path=False, exclude_model_types=None, recurse=False):
         """
@@ -121,6 +202,56 @@ class JSONApplication(WSGIApplication):
 
             self.register_model(obj, prefix_with_package_path=prefix_with_package_path)
 
+    def __encode_success(self, data):
+        body = self.json_codec.dumps({'status': 'success', 'data': data})
+        return body, hashlib.sha1(body).hexdigest()
+
+    def metadata(self, model_name=None):
+        """
+        Returns the metadata of the registered model model_name or, without
+        model_name, the list of registered models.
+        """
+        if model_name:
+            return self.converter.metadata(self.get_registered_model_type(model_name))
+
+        data = []
+        for model in self.get_registered_model_names():
+            data.append(
+                {
+                    'name': model,
+                    'url': '{0}{1}'.format(self.request.host_url, self.model_url(model)),
+                    'metadata_url': '{0}/metadata'.format(self.model_url(model))
+                }
+            )
+        return data
+
+    def metadata_document(self, model_name=None):
+        """
+        Returns (body, etag) of the encoded success response for metadata(model_name).
+
+        Documents are encoded once and reused until a model is registered or the
+        property converters change. The model list contains URLs, so it is kept
+        per host, for at most MAX_MODEL_LIST_DOCUMENTS recently used hosts.
+        """
+        if self.__metadata_generation != converter.converters_generation:
+            self.__metadata_documents = {}
+            self.__model_list_documents.flush_all()
+            self.__metadata_generation = converter.converters_generation
+
+        if model_name:
+            document = self.__metadata_documents.get(model_name)
+            if document is None:
+                document = self.__encode_success(self.metadata(model_name))
+                self.__metadata_documents[model_name] = document
+            return document
+
+        cache_key = (self.request.host_url, os.environ.get('HTTPS'))
+        document = self.__model_list_documents.get(cache_key)
+        if document is None:
+            document = self.__encode_success(self.metadata())
+            self.__model_list_documents.set(cache_key, document)
+        return document
+
     def model_url(self, model):
         protocol = 'http'
         if os.environ.get('HTTPS') == 'on':
@@ -147,21 +278,48 @@ class JSONApplication(WSGIApplication):
 
         return model_name
 
-    def get_registered_model_instance(self, model_name, key):
+    def get_registered_model_key(self, model_name, key):
+        """
+        Returns the db.Key of the registered model with numeric ID=key or
+        key()=key, without loading the model.
+
+        Exceptions:
+            ObjectMissingError if key is not a valid key for the model.
+        """
         model_class = self.get_registered_model_type(model_name)
 
         try:
             id_ = int(key)
-            try:
-                model = model_class.get_by_id(id_)
-                if not model:
-                    raise errors.ObjectMissingError('{0} with id {1} not found'.format(model_name, id_))
-            except:
-                raise errors.ObjectMissingError('{0} with id {1} not found'.format(model_name, id_))
         except ValueError:
-            try:
-                model = model_class.get(key)
-            except:
-                raise errors.ObjectMissingError('{0} with key {1} not found'.format(model_name, key))
+            id_ = None
+        if id_ is not None:
+            if id_ <= 0:
+                raise errors.ObjectMissingError('{0} with id {1} not found'.format(model_name, key))
+            return db.Key.from_path(model_class.kind(), id_)
+
+        try:
+            db_key = db.Key(key)
+        except:
+            raise errors.ObjectMissingError('{0} with key {1} not found'.format(model_name, key))
+        if db_key.kind() != model_class.kind():
+            raise errors.ObjectMissingError('{0} with key {1} not found'.format(model_name, key))
+        return db_key
+
+    def get_registered_model_instance(self, model_name, key):
+        return self.get_registered_model_instance_async(model_name, key).get_result()
+
+    def get_registered_model_instance_async(self, model_name, key):
+        """
+        Starts loading the registered model with numeric ID=key or key()=key,
+        and returns a converter.ModelFuture whose get_result() returns it.
 
-        return model
\ No newline at end of file
+        Exceptions:
+            ObjectMissingError if key is not a valid key for the model (raised
+            immediately) or the model does not exist (raised by get_result()).
+        """
+        db_key = self.get_registered_model_key(model_name, key)
+        try:
+            message = '{0} with id {1} not found'.format(model_name, int(key))
+        except ValueError:
+            message = '{0} with key {1} not found'.format(model_name, key)
+        return converter.ModelFuture(db.get_async(db_key), message)
\ No newline at end of file
@@ -0,0 +1,453 @@
+__author__ = 'Brian'
+import collections
+import hashlib
+import random
+import sys
+import threading
+import time
+
+
+def _value_size(value):
+    if isinstance(value, basestring):
+        return len(value)
+    if isinstance(value, tuple):
+        return sum(_value_size(item) for item in value)
+    return sys.getsizeof(value)
+
+
+class LRUCache(object):
+    """
+    In-process stand-in for memcache, for tests and single-instance use.
+
+    Implements the subset of the google.appengine.api.memcache.Client API
+    used by this package. Least recently used values are evicted once the
+    stored values exceed max_bytes or max_items (either may be None for no limit).
+    """
+    def __init__(self, max_bytes=8 * 1024 * 1024, max_items=None):
+        self.max_bytes = max_bytes
+        self.max_items = max_items
+        self.size = 0
+        self.__items = collections.OrderedDict()
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.__items)
+
+    def __get(self, key):
+        # Caller must hold the lock.
+        item = self.__items.pop(key, None)
+        if item is None:
+            return None
+        (value, expires, size) = item
+        if expires and expires <= time.time():
+            self.size -= size
+            return None
+        self.__items[key] = item
+        return value
+
+    def __set(self, key, value, ttl):
+        # Caller must hold the lock.
+        old = self.__items.pop(key, None)
+        if old is not None:
+            self.size -= old[2]
+        expires = time.time() + ttl if ttl else 0
+        size = _value_size(value)
+        self.__items[key] = (value, expires, size)
+        self.size += size
+        while self.__items and ((self.max_bytes is not None and self.size > self.max_bytes) or
+                                (self.max_items is not None and len(self.__items) > self.max_items)):
+            (_, evicted) = self.__items.popitem(last=False)
+            self.size -= evicted[2]
+
+    def get(self, key):
+        with self.__lock:
+            return self.__get(key)
+
+    def get_multi(self, keys, key_prefix=''):
+        result = {}
+        with self.__lock:
+            for key in keys:
+                value = self.__get(key_prefix + key)
+                if value is not None:
+                    result[key] = value
+        return result
+
+    def set(self, key, value, time=0):
+        with self.__lock:
+            self.__set(key, value, time)
+        return True
+
+    def set_multi(self, mapping, time=0, key_prefix=''):
+        with self.__lock:
+            for key, value in mapping.iteritems():
+                self.__set(key_prefix + key, value, time)
+        return []
+
+    def add(self, key, value, time=0):
+        with self.__lock:
+            if self.__get(key) is not None:
+                return False
+            self.__set(key, value, time)
+        return True
+
+    def add_multi(self, mapping, time=0, key_prefix=''):
+        not_added = []
+        with self.__lock:
+            for key, value in mapping.iteritems():
+                if self.__get(key_prefix + key) is not None:
+                    not_added.append(key)
+                else:
+                    self.__set(key_prefix + key, value, time)
+        return not_added
+
+    def incr(self, key, delta=1, initial_value=None):
+        with self.__lock:
+            value = self.__get(key)
+            if value is None:
+                if initial_value is None:
+                    return None
+                value = initial_value
+            value += delta
+            self.__set(key, value, 0)
+        return value
+
+    def offset_multi(self, mapping, key_prefix='', initial_value=None):
+        return dict((key, self.incr(key_prefix + key, delta, initial_value))
+                    for key, delta in mapping.iteritems())
+
+    def delete(self, key):
+        with self.__lock:
+            item = self.__items.pop(key, None)
+            if item is not None:
+                self.size -= item[2]
+        return 2
+
+    def delete_multi(self, keys, key_prefix=''):
+        for key in keys:
+            self.delete(key_prefix + key)
+        return True
+
+    def flush_all(self):
+        with self.__lock:
+            self.__items.clear()
+            self.size = 0
+        return True
+
+
+def _memcache_client():
+    from google.appengine.api import memcache
+    return memcache.Client()
+
+
+def _digest(*parts):
+    return hashlib.sha1('|'.join(parts)).hexdigest()
+
+
+def _initial_version():
+    # Versions start at a random value so that a version evicted and re-created
+    # never repeats one that was handed out before the eviction.
+    return random.randint(1, 2 ** 48)
+
+
+class FragmentCache(object):
+    """
+    Cache of already-encoded model JSON.
+
+    Fragments are stored under the model's key, a per-model version and a
+    variant naming anything else the encoding depends on (such as the host
+    used to build URLs), together with an entity tag hashed from the fragment.
+    Invalidating a model bumps its version, so stale fragments are never read
+    again and simply age out of the backend.
+
+    Only writes made through the API invalidate fragments. Models changed any
+    other way (the console, tasks, other code) may be served stale for up to
+    time seconds.
+
+    Arguments:
+        backend: a memcache.Client compatible object. Defaults to memcache;
+            use LRUCache for tests or to keep fragments in-process.
+        time: expiration time, in seconds, of cached fragments (0 for never).
+    """
+    def __init__(self, backend=None, time=600):
+        if backend is None:
+            backend = _memcache_client()
+        self.backend = backend
+        self.time = time
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _version_key(key):
+        return 'ajr:ver:' + _digest(str(key))
+
+    @staticmethod
+    def _fragment_key(key, version, variant):
+        return 'ajr:frag:' + _digest(str(key), str(version), variant)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def versions(self, keys):
+        """
+        Returns a dict of db.Key to current version. Keys without a version are omitted.
+        """
+        version_keys = dict((self._version_key(key), key) for key in keys)
+        found = self.backend.get_multi(version_keys.keys())
+        return dict((version_keys[k], v) for k, v in found.iteritems())
+
+    def entries(self, versions, variant):
+        """
+        Returns a dict of db.Key to (etag, encoded JSON) for the keys of
+        versions (as returned by versions()) found in the cache.
+        """
+        fragment_keys = dict((self._fragment_key(key, version, variant), key)
+                             for key, version in versions.iteritems())
+        found = {}
+        if fragment_keys:
+            found = self.backend.get_multi(fragment_keys.keys())
+        return dict((fragment_keys[k], v) for k, v in found.iteritems())
+
+    def fragments(self, versions, variant):
+        """
+        Returns a dict of db.Key to encoded JSON for the keys of versions
+        (as returned by versions()) found in the cache.
+        """
+        return dict((key, fragment) for key, (_, fragment) in self.entries(versions, variant).iteritems())
+
+    def lookup(self, keys, variant):
+        """
+        Returns (fragments, versions):
+            fragments: dict of db.Key to encoded JSON for the keys found in the cache.
+            versions: dict of db.Key to version, to be passed back to store().
+        """
+        versions = self.versions(keys)
+        fragments = self.fragments(versions, variant)
+        self.hits += len(fragments)
+        self.misses += len(keys) - len(fragments)
+        return fragments, versions
+
+    @staticmethod
+    def etag(fragment):
+        """
+        Returns the entity tag of fragment, stored with it so that a cached
+        fragment can be validated without loading or encoding the model.
+        """
+        return _digest('etag', fragment)
+
+    def store(self, fragments, versions, variant):
+        """
+        Caches fragments, a dict of db.Key to encoded JSON, under the versions
+        returned by lookup().
+
+        Returns versions, updated with the versions created for keys that had none.
+        """
+        versions = dict(versions)
+        new_versions = {}
+        for key in fragments:
+            if key not in versions:
+                new_versions[self._version_key(key)] = (key, _initial_version())
+        if new_versions:
+            not_added = self.backend.add_multi(dict((k, v[1]) for k, v in new_versions.iteritems()))
+            for version_key, (key, version) in new_versions.iteritems():
+                # Someone else created the version first; skip rather than guess it.
+                if version_key not in (not_added or []):
+                    versions[key] = version
+
+        mapping = {}
+        for key, fragment in fragments.iteritems():
+            if key in versions:
+                mapping[self._fragment_key(key, versions[key], variant)] = (self.etag(fragment), fragment)
+        if mapping:
+            self.backend.set_multi(mapping, time=self.time)
+        return versions
+
+    def invalidate(self, keys):
+        """
+        Bumps the version of every db.Key in keys so their cached fragments are no longer used.
+        """
+        if keys:
+            self.backend.offset_multi(dict((self._version_key(key), 1) for key in keys),
+                                      initial_value=_initial_version())
+
+
+class QueryCache(object):
+    """
+    Cache of search results: the keys of a page of results and the cursor of
+    the next page, stored under a canonical form of the search arguments
+    (see handlers.SearchHandler.canonical_query).
+
+    Every model kind has a generation, bumped by DictionaryConverter.models_changed
+    whenever a model of that kind is created, updated or deleted. Pages are
+    stored under the generations of the kinds they depend on, so a write makes
+    every cached page of its kind unreachable; they simply age out of the backend.
+
+    Only writes made through the API bump generations. Models changed any other
+    way (the console, tasks, other code) may be missing from, or stale in,
+    cached pages for up to time seconds. Because non-ancestor queries are
+    eventually consistent, a search run just after a write may not see it yet,
+    so no pages of a kind are stored for settle seconds after it changes.
+
+    Arguments:
+        backend: a memcache.Client compatible object. Defaults to memcache;
+            use LRUCache for tests or to keep pages in-process.
+        time: expiration time, in seconds, of cached pages (0 for never).
+        settle: seconds after a write to a kind during which its pages are not stored.
+    """
+    def __init__(self, backend=None, time=600, settle=5):
+        if backend is None:
+            backend = _memcache_client()
+        self.backend = backend
+        self.time = time
+        self.settle = settle
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _generation_key(kind):
+        return 'ajr:gen:' + _digest(kind)
+
+    @staticmethod
+    def _settle_key(kind):
+        return 'ajr:settle:' + _digest(kind)
+
+    @staticmethod
+    def _page_key(canonical, generations):
+        parts = ['{0}={1}'.format(kind, generation) for kind, generation in sorted(generations.iteritems())]
+        return 'ajr:query:' + _digest(canonical, *parts)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def generations(self, kinds):
+        """
+        Returns a dict of kind to current generation, creating missing
+        generations, or None if pages cannot be stored now: the backend did not
+        return them all, or a kind changed less than settle seconds ago.
+        """
+        generation_keys = dict((self._generation_key(kind), kind) for kind in kinds)
+        settle_keys = [self._settle_key(kind) for kind in kinds] if self.settle else []
+        found = self.backend.get_multi(generation_keys.keys() + settle_keys)
+        if any(k in found for k in settle_keys):
+            return None
+        new_generations = dict((k, _initial_version()) for k in generation_keys if k not in found)
+        if new_generations:
+            not_added = self.backend.add_multi(new_generations) or []
+            for k, generation in new_generations.iteritems():
+                if k not in not_added:
+                    found[k] = generation
+            if not_added:
+                # Someone else created these generations first.
+                found.update(self.backend.get_multi(not_added))
+        if len(found) != len(generation_keys):
+            return None
+        return dict((generation_keys[k], v) for k, v in found.iteritems())
+
+    def lookup(self, kinds, canonical):
+        """
+        Returns (page, generations):
+            page: the value stored for canonical at the current generations of kinds, or None.
+            generations: to be passed back to store(), or None if the page cannot be cached.
+        """
+        generations = self.generations(kinds)
+        page = None
+        if generations is not None:
+            page = self.backend.get(self._page_key(canonical, generations))
+        if page is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return page, generations
+
+    def store(self, canonical, generations, page):
+        """
+        Caches page for canonical under the generations returned by lookup().
+        """
+        if generations is not None:
+            self.backend.set(self._page_key(canonical, generations), page, time=self.time)
+
+    def invalidate(self, kinds):
+        """
+        Bumps the generation of every kind in kinds so their cached pages are no longer used.
+        """
+        if kinds:
+            self.backend.offset_multi(dict((self._generation_key(kind), 1) for kind in set(kinds)),
+                                      initial_value=_initial_version())
+            if self.settle:
+                self.backend.set_multi(dict((self._settle_key(kind), 1) for kind in set(kinds)), time=self.settle)
+
+
+class AuthCache(object):
+    """
+    Cache of authentication decisions, used by handlers.authenticate to avoid
+    calling the application's auth_func on every request.
+
+    Decisions are keyed by a digest of the request's credential-bearing headers
+    (by default Authorization and Cookie) and request arguments (by default
+    api_key), so this is only correct for auth functions whose decision depends
+    on those alone. Pass key_func (taking a request and returning a string) for
+    anything else, e.g. to include the request path. Requests carrying none of
+    these credentials (or for which key_func returns an empty value) are never
+    cached: auth_func is called for every one of them.
+
+    Successful authentications are kept for ttl seconds, failures
+    (AuthenticationRequiredError and ForbiddenError) for negative_ttl seconds.
+    At most max_size decisions are kept; the least recently used are evicted.
+    Call invalidate() after credentials change.
+    """
+    def __init__(self, ttl=60, negative_ttl=5, max_size=1000,
+                 headers=('Authorization', 'Cookie'), arguments=('api_key',), key_func=None):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.headers = headers
+        self.arguments = arguments
+        self.key_func = key_func
+        self.hits = 0
+        self.misses = 0
+        self.__decisions = LRUCache(max_bytes=None, max_items=max_size)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def key(self, request):
+        """
+        Returns the cache key of request's credentials, or None if it carries none.
+        """
+        if self.key_func:
+            value = self.key_func(request)
+            return _digest(value) if value else None
+        parts = [request.headers.get(header, '') for header in self.headers]
+        parts += [request.get(argument) for argument in self.arguments]
+        if not any(parts):
+            return None
+        return _digest(*[part.encode('utf-8') if isinstance(part, unicode) else part for part in parts])
+
+    def lookup(self, key):
+        """
+        Returns (found, failure) where failure is the cached exception of a failed authentication, or None.
+        """
+        decision = self.__decisions.get(key)
+        if decision is None:
+            self.misses += 1
+            return False, None
+        self.hits += 1
+        return True, decision[0]
+
+    def store(self, key, failure=None):
+        """
+        Records a successful authentication, or a failed one if failure (the raised exception) is given.
+        """
+        if failure is None:
+            self.__decisions.set(key, (None,), time=self.ttl)
+        else:
+            self.__decisions.set(key, (failure,), time=self.negative_ttl)
+
+    def invalidate(self, request=None):
+        """
+        Forgets the decision for request, or every decision if request is None.
+        """
+        if request is None:
+            self.__decisions.flush_all()
+        else:
+            key = self.key(request)
+            if key is not None:
+                self.__decisions.delete(key)
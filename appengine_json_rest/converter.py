@@ -2,20 +2,84 @@
 __author__ = 'Brian'
 from google.appengine.ext import db
 from google.appengine.api import datastore_types
-from dateutil import parser as date_parser
 import datetime
+import re
 from importlib import import_module
+import timing
+import errors
 
 FROM_PROPERTY = 0
 TO_PROPERTY = 1
 
 
+# The ISO 8601 forms produced by isoformat() (without a UTC offset), which
+# are what this API emits. Anything else goes through dateutil.
+_ISO_TIME = r'(\d{2}):(\d{2})(?::(\d{2})(?:\.(\d{1,6})\d*)?)?'
+ISO_DATE_PATTERN = re.compile(r'^(\d{4})-(\d{2})-(\d{2})$')
+ISO_DATETIME_PATTERN = re.compile(r'^(\d{4})-(\d{2})-(\d{2})[T ]' + _ISO_TIME + '$')
+ISO_TIME_PATTERN = re.compile('^' + _ISO_TIME + '$')
+
+
+def _time_args(hour, minute, second, fraction):
+    return (int(hour), int(minute), int(second or 0), int((fraction or '0').ljust(6, '0')))
+
+
+def parse_iso_datetime(s):
+    """
+    Strict, fast parser for ISO 8601 dates and date-times without a UTC offset.
+    Returns a datetime.datetime, or None if s is not in one of those forms.
+    """
+    match = ISO_DATETIME_PATTERN.match(s)
+    if match:
+        groups = match.groups()
+        try:
+            return datetime.datetime(int(groups[0]), int(groups[1]), int(groups[2]), *_time_args(*groups[3:]))
+        except ValueError:
+            return None
+
+    match = ISO_DATE_PATTERN.match(s)
+    if match:
+        try:
+            return datetime.datetime(*[int(g) for g in match.groups()])
+        except ValueError:
+            return None
+
+    return None
+
+
+def parse_iso_time(s):
+    """
+    Strict, fast parser for ISO 8601 times without a UTC offset.
+    Returns a datetime.time, or None if s is not in that form.
+    """
+    match = ISO_TIME_PATTERN.match(s)
+    if match:
+        try:
+            return datetime.time(*_time_args(*match.groups()))
+        except ValueError:
+            return None
+
+    return None
+
+
+def parse_date_string(s):
+    """
+    Parses s with dateutil, which accepts far more formats than the fast
+    parsers but is much slower. dateutil is only imported when first needed.
+    """
+    from dateutil import parser as date_parser
+    return date_parser.parse(s)
+
+
 def from_date(date):
     return date.isoformat()
 
 
 def to_date(date_string):
-    return date_parser.parse(date_string).date()
+    d = parse_iso_datetime(date_string)
+    if d is None:
+        d = parse_date_string(date_string)
+    return d.date()
 
 
 def from_datetime(d):
@@ -23,7 +87,10 @@ def from_datetime(d):
 
 
 def to_datetime(s):
-    return date_parser.parse(s)
+    d = parse_iso_datetime(s)
+    if d is None:
+        d = parse_date_string(s)
+    return d
 
 
 def from_time(t):
@@ -31,7 +98,13 @@ def from_time(t):
 
 
 def to_time(s):
-    return date_parser.parse(s).time()
+    t = parse_iso_time(s)
+    if t is not None:
+        return t
+    d = parse_iso_datetime(s)
+    if d is None:
+        d = parse_date_string(s)
+    return d.time()
 
 
 def from_geopt(p):
@@ -64,6 +137,41 @@ def from_refprop(o):
     return None
 
 
+def from_key(key):
+    if key:
+        try:
+            model_class = db.class_for_kind(key.kind())
+            model_name = model_class.__name__
+            module = model_class.__module__
+        except db.KindError:
+            model_name = key.kind()
+            module = None
+        return {
+            "model": model_name,
+            "module": module,
+            "id": key.id(),
+            "key": str(key)
+        }
+
+    return None
+
+
+def to_key(o):
+    if isinstance(o, basestring):
+        return db.Key(o)
+
+    if type(o) is dict:
+        if o.get('key'):
+            return db.Key(o.get('key'))
+
+        if o.get('module') and o.get('model') and o.get('id'):
+            module = import_module(o.get('module'))
+            cls = getattr(module, o.get('model'))
+            return db.Key.from_path(cls.kind(), o.get('id'))
+
+    return None
+
+
 def to_refprop(o):
     if type(o) is basestring:
         return db.Model.get(o)
@@ -102,13 +210,13 @@ property_converters = {
     db.GeoPtProperty: (from_geopt, to_geopt),
     datastore_types.GeoPt: (from_geopt, to_geopt),
     db.ReferenceProperty: (from_refprop, to_refprop),
+    db.Key: (from_key, to_key),
 
     # Unsupported Types
     # TODO: Support these unsupported types.
     # TODO: Updated documentation as support comes!
     # db.ListProperty
     # db.StringListProperty
-    # db.Key
     # blobstore.BlobKey
     # blobstore.BlobReferenceProperty
     # users.User
@@ -151,8 +259,123 @@ class UnhandledPropertyError(Exception):
     pass
 
 
+# Bumped whenever property_converters changes so cached ModelPlans get rebuilt.
+converters_generation = 0
+
+
 def register_property_converter(property_type, from_property_fn, to_property_fn):
+    global converters_generation
     property_converters[property_type] = (from_property_fn, to_property_fn)
+    converters_generation += 1
+
+
+class PropertyPlan(object):
+    """
+    A single property of a ModelPlan, with its converter functions
+    already looked up.
+    """
+    def __init__(self, name, prop):
+        self.name = name
+        self.prop = prop
+        self.is_list = type(prop) is db.ListProperty
+        self.is_reference = type(prop) is db.ReferenceProperty
+        if self.is_list:
+            converter_type = prop.item_type
+        else:
+            converter_type = type(prop)
+        self.from_fn = get_property_converter_function(FROM_PROPERTY, converter_type)
+        self.to_fn = get_property_converter_function(TO_PROPERTY, converter_type)
+        if self.is_reference:
+            # Unexpanded references are rendered from the stored key alone.
+            self.from_key_fn = get_property_converter_function(FROM_PROPERTY, db.Key)
+
+    def convert(self, direction, value):
+        if direction == FROM_PROPERTY:
+            fn = self.from_fn
+        else:
+            fn = self.to_fn
+
+        if self.is_list:
+            return [fn(item) for item in value]
+        return fn(value)
+
+
+class ModelPlan(object):
+    """
+    Serialization plan for a db.Model class.
+
+    Introspecting a model class (its properties, their converters and its
+    back-references) is done once here instead of for every instance that
+    DictionaryConverter reads.
+
+    Attributes:
+        properties: list of PropertyPlan, in model._properties order.
+        properties_by_name: dict of property name to PropertyPlan.
+        references: the PropertyPlans of the model's ReferenceProperties.
+        back_references: list of (attribute_name, search_path) tuples, one per
+            ReferenceProperty in another registered model pointing at this one.
+            The id of the instance is appended to search_path to form the query URL.
+    """
+    def __init__(self, application, model_class):
+        self.model_class = model_class
+        self.generation = converters_generation
+        self.properties = []
+        self.properties_by_name = {}
+        for name, prop in model_class._properties.iteritems():
+            prop_plan = PropertyPlan(name, prop)
+            self.properties.append(prop_plan)
+            self.properties_by_name[name] = prop_plan
+        self.references = [p for p in self.properties if p.is_reference]
+
+        self.back_references = []
+        for name in dir(model_class):
+            attr = getattr(model_class, name, None)
+            if isinstance(attr, db._ReverseReferenceProperty):
+                refprop_class_name = application.get_registered_name(attr._model)
+                search_path = "{0}/search?ref_{1}=".format(refprop_class_name, attr._prop_name)
+                self.back_references.append((name, search_path))
+
+
+class ModelFuture(object):
+    """
+    A model being loaded, as returned by JSONApplication.get_registered_model_instance_async.
+    """
+    def __init__(self, rpc, message):
+        self.rpc = rpc
+        self.message = message
+
+    def get_result(self):
+        """
+        Waits for and returns the model.
+
+        Exceptions:
+            ObjectMissingError if the model does not exist.
+        """
+        model = self.rpc.get_result()
+        if model is None:
+            raise errors.ObjectMissingError(self.message)
+        return model
+
+
+class WriteFuture(object):
+    """
+    Result of DictionaryConverter.put_models_async and delete_models_async.
+    get_result() waits for the write and only then reports the changed keys to
+    models_changed(), so caches are never invalidated before the write is done.
+    """
+    def __init__(self, converter, rpc, models=None, keys=None):
+        self.converter = converter
+        self.rpc = rpc
+        self.models = models
+        self.keys = keys
+        self.done = False
+
+    def get_result(self):
+        if not self.done:
+            keys = self.rpc.get_result()
+            self.done = True
+            self.converter.models_changed(self.keys if self.keys is not None else keys)
+        return self.models
 
 
 class DictionaryConverter(object):
@@ -165,54 +388,121 @@ class DictionaryConverter(object):
     '''
     def __init__(self, application):
         self.application = application
-
-    def __convert_property(self, direction, prop, value):
-        if type(prop) is db.ListProperty:
-            result = []
-            fn = get_property_converter_function(direction, prop.item_type)
-            for item in value:
-                result.append(fn(item))
-            return result
-
-        fn = get_property_converter_function(direction, type(prop))
-        return fn(value)
-
-    def _type_from_property(self, model, prop):
-        value = getattr(model, prop.name)
-        rc = self.__convert_property(FROM_PROPERTY, prop, value)
-        if type(prop) is db.ReferenceProperty and rc:
+        self.__plans = {}
+
+    def plan(self, model_class):
+        """
+        Returns the ModelPlan for model_class, building it on first use or
+        when the registered property converters have changed since it was built.
+        """
+        plan = self.__plans.get(model_class)
+        if plan is None or plan.generation != converters_generation:
+            plan = ModelPlan(self.application, model_class)
+            self.__plans[model_class] = plan
+        return plan
+
+    def clear_plans(self):
+        self.__plans = {}
+
+    def __property_plan(self, prop):
+        prop_plan = self.plan(prop.model_class).properties_by_name.get(prop.name)
+        if prop_plan is None or prop_plan.prop is not prop:
+            prop_plan = PropertyPlan(prop.name, prop)
+        return prop_plan
+
+    def _type_from_property(self, model, prop_plan, expand=None, references=None):
+        if not prop_plan.is_reference:
+            return prop_plan.convert(FROM_PROPERTY, getattr(model, prop_plan.name))
+
+        ref_key = prop_plan.prop.get_value_for_datastore(model)
+        if not expand or prop_plan.name not in expand:
+            rc = prop_plan.from_key_fn(ref_key)
+            if rc:
+                rc['url'] = '{0}/{1}'.format(self.application.model_url(rc['model']), rc['id'])
+            return rc
+
+        if references is not None and ref_key in references:
+            referenced = references[ref_key]
+        else:
+            referenced = getattr(model, prop_plan.name)
+        rc = prop_plan.convert(FROM_PROPERTY, referenced)
+        if rc:
             rc['url'] = '{0}/{1}'.format(self.application.model_url(rc['model']), rc['id'])
+            rc['data'] = self.read_model(referenced)
         return rc
 
     def _property_from_type(self, prop, value):
-        return self.__convert_property(TO_PROPERTY, prop, value)
+        if prop is None:
+            return identity(value)
+        return self.__property_plan(prop).convert(TO_PROPERTY, value)
+
+    def prefetch_references(self, models, expand):
+        """
+        Loads the entities referenced by the ReferenceProperties of models
+        named in expand using a single db.get() call.
+
+        Returns a dict of db.Key to referenced model (None if the referenced
+        entity no longer exists), suitable for the references argument of read_model.
+        """
+        if not expand:
+            return {}
+
+        keys = set()
+        for model in models:
+            for prop_plan in self.plan(type(model)).references:
+                if prop_plan.name not in expand:
+                    continue
+                ref_key = prop_plan.prop.get_value_for_datastore(model)
+                if ref_key:
+                    keys.add(ref_key)
+
+        if not keys:
+            return {}
+        keys = list(keys)
+        return dict(zip(keys, db.get(keys)))
 
     # HTTP GET
-    def read_model(self, model):
+    @timing.timed('convert')
+    def read_model(self, model, expand=None, references=None, fields=None):
+        """
+        Returns a dict representation of model.
+
+        ReferenceProperties are rendered from their stored key without loading
+        the referenced model, unless the property is named in expand. Expanded
+        references also carry the referenced model under "data".
+
+        expand: optional set of ReferenceProperty names to load.
+        references: optional dict returned by prefetch_references(); referenced
+            models found in it are not loaded from the datastore again.
+        fields: optional set of property and back-reference names; when given,
+            only those (plus key and id) are converted and returned.
+        """
+        plan = self.plan(type(model))
+        key = model.key()
         result = {
-            'key': str(model.key()),
-            'id': model.key().id()
+            'key': str(key),
+            'id': key.id()
         }
         # Add ordinary properties
-        for name, prop in model._properties.iteritems():
-            result[name] = self._type_from_property(model, prop)
-
-        model_type = type(model)
+        for prop_plan in plan.properties:
+            if fields and prop_plan.name not in fields:
+                continue
+            result[prop_plan.name] = self._type_from_property(model, prop_plan, expand, references)
 
         # Provide Query URL for reference properties
-        for name in dir(model):
-            obj = getattr(model, name)
-            if type(obj) is db.Query:
-                refprop_class = obj._model_class
-                refprop_class_name = self.application.get_registered_name(refprop_class)
-                url = self.application.model_url(refprop_class_name) + "/search"
-                refprop_name = getattr(model_type, name)._prop_name
-                url += "?ref_{0}={1}".format(refprop_name, model.key().id())
-                result[name] = {'query': url}
+        for name, search_path in plan.back_references:
+            if fields and name not in fields:
+                continue
+            url = self.application.model_url('{0}{1}'.format(search_path, key.id()))
+            result[name] = {'query': url}
         return result
 
-    # HTTP PUT (update), Idempotent
-    def update_model(self, model, values):
+    @timing.timed('convert')
+    def set_values(self, model, values):
+        """
+        Converts values and assigns them to the matching properties of model,
+        without saving it. Keys that are not properties of model are ignored.
+        """
         converted_values = {}
         for (k, v) in values.iteritems():
             prop = model._properties.get(k)
@@ -221,21 +511,78 @@ class DictionaryConverter(object):
 
         for k, v in converted_values.iteritems():
             setattr(model, k, v)
-        model.put()
         return model
 
-    # HTTP POST (create), will create multiple items if called multiple times
-    def create_model(self, model_type, values):
+    def new_model(self, model_type, values):
+        """
+        Returns a new, unsaved model_type instance built from values.
+        """
         converted_values = {}
         for (k, v) in values.iteritems():
             prop = model_type._properties.get(k)
             if prop:
                 converted_values[k] = self._property_from_type(prop, v)
 
-        model = model_type(**converted_values)
+        return model_type(**converted_values)
+
+    def put_models(self, models):
+        """
+        Saves models with a single datastore call.
+        """
+        return self.put_models_async(models).get_result()
+
+    def put_models_async(self, models):
+        """
+        Starts saving models with a single datastore call. Returns a WriteFuture
+        whose get_result() waits for the save and returns models.
+
+        Models are saved with db.put_async, so Model.put() overrides do not run.
+        """
+        return WriteFuture(self, db.put_async(models), models)
+
+    def put_model(self, model):
+        """
+        Saves a single model with model.put(), so that Model.put() overrides
+        (e.g. setting timestamps or validating) run.
+        """
         model.put()
+        self.models_changed([model.key()])
         return model
 
+    # HTTP PUT (update), Idempotent
+    def update_model(self, model, values):
+        self.set_values(model, values)
+        return self.put_model(model)
+
+    # HTTP POST (create), will create multiple items if called multiple times
+    def create_model(self, model_type, values):
+        model = self.new_model(model_type, values)
+        return self.put_model(model)
+
+    # HTTP DELETE
+    def delete_models(self, keys):
+        """
+        Deletes the models with the given db.Keys with a single datastore
+        call, without loading them.
+        """
+        self.delete_models_async(keys).get_result()
+
+    def delete_models_async(self, keys):
+        """
+        Starts deleting the models with the given db.Keys. Returns a WriteFuture
+        whose get_result() waits for the deletion.
+        """
+        return WriteFuture(self, db.delete_async(keys), keys=keys)
+
+    def models_changed(self, keys):
+        """
+        Called with the keys of models saved or deleted through this converter.
+        """
+        if self.application.fragment_cache:
+            self.application.fragment_cache.invalidate(keys)
+        if self.application.query_cache and keys:
+            self.application.query_cache.invalidate([key.kind() for key in keys])
+
     def metadata(self, cls):
         result = {}
         for name, prop in cls._properties.iteritems():
@@ -1,12 +1,19 @@
+import hashlib
+import itertools
 import json
 import os
 import re
 import logging
+import time
 import webapp2
+import zlib
 
+from google.appengine.ext import db
 from google.appengine.ext import webapp
 
 import errors
+from converter import ModelFuture
+import timing
 
 
 __author__ = 'Brian'
@@ -21,6 +28,71 @@ QUERY_EXPRS = {
     "fge_": "{0} >=",
     "fne_": "{0} !="}
 
+# Stands in for already-encoded JSON fragments; see JsonHandler.api_success_fragments.
+FRAGMENT_PLACEHOLDER = '__appengine_json_rest_fragments__'
+
+# Appended to the ETag of gzip-encoded responses, which are a different representation.
+GZIP_ETAG_SUFFIX = '-gzip'
+
+
+def accepts_gzip(accept_encoding):
+    """
+    Returns True if the Accept-Encoding header value accept_encoding allows gzip.
+    """
+    for coding in (accept_encoding or '').split(','):
+        parts = [part.strip() for part in coding.split(';')]
+        if parts[0].lower() not in ('gzip', 'x-gzip'):
+            continue
+        for param in parts[1:]:
+            if param.startswith('q='):
+                try:
+                    return float(param[2:]) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+
+def gzip_compressor(level):
+    return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+def gzip_iter(chunks, level):
+    """
+    Gzip-compresses the strings produced by the iterable chunks, as they are produced.
+    """
+    compressor = gzip_compressor(level)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def run_authenticator(app, request):
+    """
+    Calls the application's authenticator for request, going through the
+    application's AuthCache when it has one and the request carries credentials.
+    """
+    auth_cache = app.auth_cache
+    cache_key = auth_cache.key(request) if auth_cache else None
+    if cache_key is None:
+        app.authenticator(request)
+        return
+
+    (found, failure) = auth_cache.lookup(cache_key)
+    if found:
+        if failure:
+            raise failure
+        return
+
+    try:
+        app.authenticator(request)
+    except (errors.AuthenticationRequiredError, errors.ForbiddenError) as exception:
+        auth_cache.store(cache_key, exception)
+        raise
+    auth_cache.store(cache_key)
+
 
 def authenticate(function):
     """
@@ -38,7 +110,8 @@ def authenticate(function):
 
         if webapp2.get_app().authenticator:
             try:
-                webapp2.get_app().authenticator(self.request)
+                with timing.phase('auth'):
+                    run_authenticator(webapp2.get_app(), self.request)
             except errors.AuthenticationRequiredError as exception:
                 if not exception.headers or not exception.headers.get('WWW-Authenticate'):
                     # A WWW-Authenticate header is required; without it the negotiation for authentication fails.
@@ -85,14 +158,161 @@ class JsonHandler(webapp.RequestHandler):
         else:
             self.indent = None
 
-    def __render_json(self, data):
-        self.response.write(json.dumps(data, indent=self.indent))
+    # Set by timed_body for responses whose body is produced after dispatch returns.
+    streamed = False
+
+    def dispatch(self):
+        """
+        Times the request when the application has timing enabled: sets the
+        Server-Timing header and records the timings in the application's TimingStats.
+        Streamed responses (see timed_body) are recorded once their body is
+        finished, without a Server-Timing header, which would only cover their start.
+        """
+        stats = webapp2.get_app().timing_stats
+        if stats is None:
+            return super(JsonHandler, self).dispatch()
+
+        timer = timing.start()
+        try:
+            return super(JsonHandler, self).dispatch()
+        finally:
+            timing.finish()
+            if not self.streamed:
+                self.response.headers['Server-Timing'] = timer.server_timing()
+                self.record_timing(stats, timer)
+
+    def record_timing(self, stats, timer):
+        stats.record('{0} {1}'.format(self.request.method, self.__class__.__name__), self.stats_model_name(), timer)
+
+    def timed_body(self, chunks):
+        """
+        Returns an iterable producing the strings of chunks, a response body
+        produced after dispatch returns, that goes on timing the request while
+        it runs. Returns chunks itself when timing is disabled.
+        """
+        timer = timing.current()
+        if timer is None:
+            return chunks
+        self.streamed = True
+        return self.__timed_chunks(webapp2.get_app().timing_stats, timer, chunks)
+
+    def __timed_chunks(self, stats, timer, chunks):
+        timing.resume(timer)
+        try:
+            for chunk in chunks:
+                yield chunk
+        finally:
+            timing.finish()
+            self.record_timing(stats, timer)
+
+    def stats_model_name(self):
+        """
+        Returns the registered model name the request's timings are recorded under,
+        or None for unregistered names and unauthenticated or forbidden requests.
+        """
+        if not self.request.route_args or self.response.status_int in (401, 403):
+            return None
+        model_name = self.request.route_args[0]
+        try:
+            webapp2.get_app().get_registered_model_type(model_name)
+        except errors.ModelNotRegisteredError:
+            return None
+        return model_name
+
+    def encode_json(self, data):
+        with timing.phase('encode'):
+            return webapp2.get_app().json_codec.dumps(data, indent=self.indent)
+
+    def __render_json(self, data, etag=None):
+        self.write_body(self.encode_json(data), etag)
+
+    def write_body(self, body, etag=None):
+        """
+        Writes body, the encoded JSON response.
+        Successful GET responses carry a strong ETag (etag, or a hash of body)
+        and become 304 Not Modified if it matches the request's If-None-Match.
+        The body is gzip-encoded when negotiated (see gzip_level).
+        """
+        level = self.gzip_level()
+        if level and len(body) < webapp2.get_app().gzip_min_size:
+            level = None
+
+        if self.request.method == 'GET' and self.response.status_int == 200:
+            if etag is None:
+                etag = hashlib.sha1(body).hexdigest()
+            if level:
+                etag += GZIP_ETAG_SUFFIX
+            if self.not_modified(etag):
+                return
+
+        if level:
+            with timing.phase('gzip'):
+                compressor = gzip_compressor(level)
+                body = compressor.compress(body) + compressor.flush()
+            self.response.headers['Content-Encoding'] = 'gzip'
+        self.response.write(body)
+
+    def gzip_level(self):
+        """
+        Returns the compression level to gzip this response with, or None if the
+        application has compression disabled or the client does not accept gzip.
+        """
+        level = webapp2.get_app().gzip_level
+        if not level:
+            return None
+        self.response.headers['Vary'] = 'Accept-Encoding'
+        if not accepts_gzip(self.request.headers.get('Accept-Encoding')):
+            return None
+        return level
+
+    def not_modified(self, etag):
+        """
+        Sets the ETag header. If the request's If-None-Match matches etag
+        (with or without GZIP_ETAG_SUFFIX), sets status 304 Not Modified with
+        an empty body and returns True.
+        """
+        self.response.headers['ETag'] = '"{0}"'.format(etag)
+        base_etag = etag[:-len(GZIP_ETAG_SUFFIX)] if etag.endswith(GZIP_ETAG_SUFFIX) else etag
+        for candidate in (base_etag, base_etag + GZIP_ETAG_SUFFIX):
+            if candidate in self.request.if_none_match:
+                self.response.headers['ETag'] = '"{0}"'.format(candidate)
+                self.response.set_status(304)
+                del self.response.headers['Content-Type']
+                return True
+        return False
 
-    def api_success(self, data=None):
+    def api_success(self, data=None, etag=None):
         response = {'status': 'success'}
         if data is not None:
             response['data'] = data
-        self.__render_json(response)
+        self.__render_json(response, etag)
+
+    def api_success_fragments(self, data, fragments, etag=None):
+        """
+        Like api_success, but FRAGMENT_PLACEHOLDER in data is replaced by the
+        already-encoded JSON fragments, separated by commas.
+        """
+        response = {'status': 'success', 'data': data}
+        body = self.encode_json(response)
+        body = body.replace(json.dumps(FRAGMENT_PLACEHOLDER), ','.join(fragments), 1)
+        self.write_body(body, etag)
+
+    def usable_fragment_cache(self, expand=None):
+        """
+        Returns the application's FragmentCache, or None if the response
+        cannot be assembled from cached fragments.
+        Fragments are encoded compactly and never include expanded references,
+        which could change without the model itself changing.
+        """
+        if self.indent or expand:
+            return None
+        return webapp2.get_app().fragment_cache
+
+    def fragment_variant(self, fields=None):
+        variant = str(self.request.host_url)
+        if fields:
+            variant += '|' + ','.join(sorted(fields))
+        return variant
 
     def api_fail(self, message=None, data=None, exception_class_name=None, status_code=404):
         response = {'status': 'error'}
@@ -105,6 +325,21 @@ class JsonHandler(webapp.RequestHandler):
         self.response.set_status(status_code)
         self.__render_json(response)
 
+    def read_json_body(self):
+        import urllib
+        with timing.phase('decode'):
+            json_string = urllib.unquote(self.request.body)
+            return webapp2.get_app().json_codec.loads(json_string)
+
+    def list_argument(self, name):
+        """
+        Returns the comma-separated values of querystring argument name as a list.
+        """
+        value = self.request.get(name)
+        if not value:
+            return []
+        return [item.strip() for item in value.split(',') if item.strip()]
+
     def set_location_header(self, model):
         self.response.headers["Location"] = "{0}/{1}".format(self.request.path, model.key().id())
 
@@ -147,22 +382,50 @@ class MetadataHandler(JsonHandler):
     """
     @authenticate
     def get(self, modelName=None):
-        if modelName:
-            modelClass = webapp2.get_app().get_registered_model_type(modelName)
-            metadata = webapp2.get_app().converter.metadata(modelClass)
-            self.api_success(metadata)
+        app = webapp2.get_app()
+        if self.indent:
+            self.api_success(app.metadata(modelName))
         else:
-            models = webapp2.get_app().get_registered_model_names()
-            data = []
-            for model in models:
-                data.append(
-                    {
-                        'name': model,
-                        'url': '{0}{1}'.format(self.request.host_url, webapp2.get_app().model_url(model)),
-                        'metadata_url': '{0}/metadata'.format(webapp2.get_app().model_url(model))
-                    }
-                )
-            self.api_success(data)
+            # Precomputed by the application; see JSONApplication.metadata_document.
+            body, etag = app.metadata_document(modelName)
+            self.write_body(body, etag)
+
+
+class StatsHandler(JsonHandler):
+    """
+    Request timing statistics, when the application was created with timing=True.
+
+    GET /rest/_stats:
+        Returns {"status":"success", "data":[stats]} with one item per route
+        (HTTP method and handler) and model name:
+        {
+            "route": "GET SearchHandler",
+            "model": "ModelName",
+            "count": requests,
+            "mean_ms": mean duration,
+            "p50_ms", "p95_ms", "p99_ms": histogram bucket bounds (null above the largest bucket),
+            "mean_rpcs": mean number of datastore RPCs,
+            "mean_phase_ms": {phase: mean duration},
+            "buckets_ms": {bucket upper bound: requests}
+        }
+
+    DELETE /rest/_stats:
+        Clears the statistics.
+    """
+    def timing_stats(self):
+        stats = webapp2.get_app().timing_stats
+        if stats is None:
+            raise errors.ObjectMissingError('Request timing is not enabled.')
+        return stats
+
+    @authenticate
+    def get(self):
+        self.api_success(self.timing_stats().snapshot())
+
+    @authenticate
+    def delete(self):
+        self.timing_stats().reset()
+        self.api_success()
 
 
 class SingleModelHandler(JsonHandler):
@@ -182,9 +445,43 @@ class SingleModelHandler(JsonHandler):
                 ...
             }
         }
+
+        Querystring Parameters:
+            expand: comma-separated ReferenceProperty names to load and include
+                under the reference's "data" value.
+            fields: comma-separated property (or back-reference) names; only
+                those, plus key and id, are returned.
         """
-        model = webapp2.get_app().get_registered_model_instance(modelName, key)
-        self.api_success(webapp2.get_app().converter.read_model(model))
+        app = webapp2.get_app()
+        converter = app.converter
+        expand = set(self.list_argument('expand'))
+        fields = set(self.list_argument('fields'))
+
+        cache = self.usable_fragment_cache(expand)
+        if cache:
+            db_key = app.get_registered_model_key(modelName, key)
+            variant = self.fragment_variant(fields)
+            versions = cache.versions([db_key])
+            entry = cache.entries(versions, variant).get(db_key)
+            if entry is None:
+                cache.misses += 1
+                model = app.get_registered_model_instance(modelName, key)
+                fragment = self.encode_json(converter.read_model(model, fields=fields))
+                cache.store({db_key: fragment}, versions, variant)
+                etag = cache.etag(fragment)
+            else:
+                cache.hits += 1
+                # The cached entity tag identifies the response without loading the model.
+                (etag, fragment) = entry
+                if self.not_modified(etag):
+                    return
+
+            self.api_success_fragments(FRAGMENT_PLACEHOLDER, [fragment], etag)
+            return
+
+        model = app.get_registered_model_instance(modelName, key)
+        references = converter.prefetch_references([model], expand)
+        self.api_success(converter.read_model(model, expand=expand, references=references, fields=fields))
 
     @authenticate
     def post(self, modelName):
@@ -207,9 +504,7 @@ class SingleModelHandler(JsonHandler):
         https://developers.google.com/appengine/docs/python/datastore/keyclass#Key_id
         """
         model_class = webapp2.get_app().get_registered_model_type(modelName)
-        import urllib
-        json_string = urllib.unquote(self.request.body)
-        values = json.loads(json_string)
+        values = self.read_json_body()
 
         model = webapp2.get_app().converter.create_model(model_class, values)
         self.response.set_status(201)
@@ -234,17 +529,18 @@ class SingleModelHandler(JsonHandler):
 
         Where key is the passed-in parameter
         """
-        model = webapp2.get_app().get_registered_model_instance(modelName, key)
-        import urllib
-        json_string = urllib.unquote(self.request.body)
-        values = json.loads(json_string)
+        app = webapp2.get_app()
+        # The body is decoded while the model loads.
+        future = app.get_registered_model_instance_async(modelName, key)
+        values = self.read_json_body()
+        model = future.get_result()
 
-        model = webapp2.get_app().converter.update_model(model, values)
+        app.converter.update_model(model, values)
         self.set_location_header(model)
-        self.api_success(webapp2.get_app().converter.read_model(model))
+        self.api_success(app.converter.read_model(model))
 
     @authenticate
-    def delete(self, modelName, key):
+    def delete(self, modelName, key=None):
         """
         Delete existing model with key().id() == key or key()==key.
         Usage: HTTP DELETE to /rest/ModelName/id_or_key
@@ -255,15 +551,228 @@ class SingleModelHandler(JsonHandler):
         }
 
         Where key is the passed-in parameter
+
+        Delete many models at once:
+        Usage: HTTP DELETE to /rest/ModelName?ids=id_or_key,id_or_key,...
+        Returns:
+        {
+            "status": "success",
+            "data": [keys]
+        }
+
+        The model is deleted by key without being loaded first, so deleting
+        a model that does not exist succeeds.
+
+        Querystring Parameters:
+            verify: if set, respond with 404 (and delete nothing) when a model does not exist.
         """
-        model = webapp2.get_app().get_registered_model_instance(modelName, key)
-        model.delete()
+        app = webapp2.get_app()
+        if key is None:
+            ids = self.list_argument('ids')
+            if not ids:
+                raise errors.ApiFailureError('ids parameter is required to delete without an id in the URL')
+        else:
+            ids = [key]
+
+        keys = [app.get_registered_model_key(modelName, id_) for id_ in ids]
+        if self.request.get('verify'):
+            for id_, model in zip(ids, db.get(keys)):
+                if model is None:
+                    raise errors.ObjectMissingError('{0} with id {1} not found'.format(modelName, id_))
+
+        app.converter.delete_models(keys)
+
+        deleted = []
+        for id_ in ids:
+            try:
+                deleted.append(int(id_))
+            except (TypeError, ValueError):
+                deleted.append(id_)
+
+        if key is None:
+            self.api_success(deleted)
+        else:
+            self.api_success(deleted[0])
+
+
+class BatchHandler(JsonHandler):
+    """
+    Reads (GET), creates (POST) and updates (PUT) many instances of a model
+    in one request, using a single datastore call for each.
+    See individual handlers below for details.
+
+    Returns:
+    {
+        "status": "success",
+        "data": [results]
+    }
+
+    results holds one entry per requested item, in request order, each in the form:
+        {"status": "success", "data": {model}}
+    or
+        {"status": "error", "type": unicode, "message": unicode}
+    """
+    @staticmethod
+    def item_success(data):
+        return {'status': 'success', 'data': data}
+
+    @staticmethod
+    def item_error(exception):
+        if isinstance(exception, errors.ApiFailureError):
+            message = exception.value
+        else:
+            message = str(exception)
+        return {'status': 'error', 'type': exception.__class__.__name__, 'message': message}
+
+    def read_items(self):
+        items = self.read_json_body()
+        if type(items) is not list:
+            raise errors.ApiFailureError('batch requests require a JSON array')
+        return items
+
+    def put_and_read(self, models, positions, results):
+        if not models:
+            return
+        converter = webapp2.get_app().converter
+        data = None
         try:
-            id_ = int(key)
-        except TypeError:
-            id_ = key
+            write = converter.put_models_async(models)
+            # Models that already have keys (updates) are converted while they save.
+            if all(model.has_key() for model in models):
+                data = [converter.read_model(model) for model in models]
+            write.get_result()
+        except Exception as exception:
+            for i in positions:
+                results[i] = self.item_error(exception)
+            return
+
+        if data is None:
+            data = [converter.read_model(model) for model in models]
+        for i, item in zip(positions, data):
+            results[i] = self.item_success(item)
+
+    def get_models(self, modelName, ids, results):
+        """
+        Loads the models with the given ids using a single db.get() call.
+        Returns (models, positions) where positions[n] is the index in ids of models[n].
+        Missing models and invalid ids are recorded as errors in results.
+        """
+        app = webapp2.get_app()
+        keys = []
+        positions = []
+        for i, id_ in enumerate(ids):
+            if id_ is None:
+                results[i] = self.item_error(errors.ObjectMissingError('{0} item has no id or key'.format(modelName)))
+                continue
+            try:
+                keys.append(app.get_registered_model_key(modelName, id_))
+                positions.append(i)
+            except errors.ApiFailureError as exception:
+                results[i] = self.item_error(exception)
+
+        found_models = []
+        found_positions = []
+        if keys:
+            for i, model in zip(positions, db.get(keys)):
+                if model is None:
+                    results[i] = self.item_error(
+                        errors.ObjectMissingError('{0} with id {1} not found'.format(modelName, ids[i])))
+                else:
+                    found_models.append(model)
+                    found_positions.append(i)
+        return found_models, found_positions
+
+    @authenticate
+    def get(self, modelName):
+        """
+        Usage: HTTP GET to /rest/ModelName/batch?ids=id_or_key,id_or_key,...
+
+        Querystring Parameters:
+            ids: comma-separated numeric IDs or keys of the models to read.
+            expand: as for SingleModelHandler.get.
+        """
+        webapp2.get_app().get_registered_model_type(modelName)
+        converter = webapp2.get_app().converter
+        ids = self.list_argument('ids')
+        results = [None] * len(ids)
+        models, positions = self.get_models(modelName, ids, results)
+
+        expand = set(self.list_argument('expand'))
+        references = converter.prefetch_references(models, expand)
+        for i, model in zip(positions, models):
+            results[i] = self.item_success(converter.read_model(model, expand=expand, references=references))
+        self.api_success(results)
 
-        self.api_success(id_)
+    @authenticate
+    def post(self, modelName):
+        """
+        Create new instances of model.
+        Usage: HTTP POST to /rest/ModelName/batch with ContentType=application/json
+        Input:
+        [
+            {
+                "property_name": property_value,
+                ...
+            },
+            ...
+        ]
+        """
+        model_class = webapp2.get_app().get_registered_model_type(modelName)
+        converter = webapp2.get_app().converter
+        items = self.read_items()
+        results = [None] * len(items)
+        models = []
+        positions = []
+        for i, values in enumerate(items):
+            try:
+                models.append(converter.new_model(model_class, values))
+                positions.append(i)
+            except Exception as exception:
+                results[i] = self.item_error(exception)
+
+        self.put_and_read(models, positions, results)
+        self.api_success(results)
+
+    @authenticate
+    def put(self, modelName):
+        """
+        Update existing instances of model.
+        Usage: HTTP PUT to /rest/ModelName/batch with ContentType=application/json
+        Input:
+        [
+            {
+                "id": id_or_key,
+                "property_name": property_value,
+                ...
+            },
+            ...
+        ]
+
+        Each item identifies its model by "id" (numeric ID) or "key" (key()).
+        """
+        webapp2.get_app().get_registered_model_type(modelName)
+        converter = webapp2.get_app().converter
+        items = self.read_items()
+        results = [None] * len(items)
+        ids = []
+        for item in items:
+            if type(item) is dict:
+                ids.append(item.get('id') or item.get('key'))
+            else:
+                ids.append(None)
+        models, positions = self.get_models(modelName, ids, results)
+
+        put_models = []
+        put_positions = []
+        for i, model in zip(positions, models):
+            try:
+                put_models.append(converter.set_values(model, items[i]))
+                put_positions.append(i)
+            except Exception as exception:
+                results[i] = self.item_error(exception)
+
+        self.put_and_read(put_models, put_positions, results)
+        self.api_success(results)
 
 
 class SearchHandler(JsonHandler):
@@ -275,12 +784,14 @@ class SearchHandler(JsonHandler):
             "status":"success",
             "data"={
                 "models": [models],
-                "cursor": cursor
+                "cursor": cursor,
+                "max_limit": max_limit
         }
 
         models: a list of dicts of containing model definitions.
         cursor: an opaque string to be passed back to Search handler for subsequent pages.
             null if there are no more models to query
+        max_limit: the largest page size the server will return (see JSONApplication's max_page_size).
 
         Failure: {"status":"error", "message"=error_detail}
 
@@ -310,21 +821,82 @@ class SearchHandler(JsonHandler):
             Querystring value: integer specifying number of results per query.
             Note: AppEngine has a hard limit of 1,000 models, and the request
                   may time out before 1,000 models due to processing overhead.
+                  Limits above max_limit are reduced to max_limit.
+
+        Expanded References:
+            Querystring name: "expand"
+            Querystring value: comma-separated ReferenceProperty names.
+            By default references are rendered from their stored key only. Named
+            references are loaded (with one batched get per page) and included
+            under the reference's "data" value.
+
+        Fields:
+            Querystring name: "fields"
+            Querystring value: comma-separated property (or back-reference) names.
+            Only the named fields, plus key and id, are returned. When every field
+            is an indexed property the search runs as a datastore projection query.
+
+        Keys Only:
+            Querystring name: "keys_only"
+            Querystring value: any non-empty value, e.g. "keys_only=1".
+            Runs a keys-only query and returns models as {"id": id, "key": key}
+            without loading them.
+
+        Time Budget:
+            Querystring name: "budget"
+            Querystring value: seconds, e.g. "budget=5". Defaults to the
+            application's search_budget.
+            The query is read and converted in batches. When the next batch would
+            not fit in the budget, the page is returned early with the models
+            converted so far, "partial": true, and a cursor continuing right
+            after the last returned model. Pages of a budgeted search always
+            carry "partial".
 
     """
-    @authenticate
-    def get(self, model_name):
-        try:
-            modelClass = webapp2.get_app().get_registered_model_type(model_name)
-        except TypeError:
-            raise errors.ModelNotRegisteredError(model_name)
+    BUDGET_BATCH_SIZE = 50
 
-        data = {
-            'models': []
-        }
-        query = modelClass.all()
-        next_page_querystring = ''
-        limit = 20
+    @staticmethod
+    def projection_for(modelClass, fields, filters, orders):
+        """
+        Returns the projection to use for a query returning only fields, or None
+        if the query cannot be a projection query: every field must be an indexed,
+        single-valued property that is not used in an equality filter, and every
+        sort order must be on a projected property.
+        """
+        if not fields:
+            return None
+        for expression, _ in filters:
+            (name, operator) = expression.split(' ')
+            if operator == '=' and name in fields:
+                return None
+        for order in orders:
+            if order.lstrip('-') not in fields:
+                return None
+        for name in fields:
+            prop = modelClass._properties.get(name)
+            if prop is None or not prop.indexed or isinstance(prop, db.ListProperty):
+                return None
+        return tuple(sorted(fields))
+
+    def build_query(self, modelClass, limit=20, projection=True, keys_only=False):
+        """
+        Builds the query described by the request's ref_, filter, order and cursor arguments.
+
+        Returns (query, next_page_querystring, limit) where next_page_querystring
+        is as returned by next_page_arguments and limit is the requested page
+        size, or the given default.
+
+        The model named by a ref_ argument is loaded asynchronously; run_query
+        checks that it exists while the query runs.
+
+        When keys_only is True, the query returns db.Keys. Otherwise, when
+        projection is True and the request's fields can all be projected
+        (see projection_for), a projection query is returned.
+        """
+        filters = []
+        orders = []
+        cursor = None
+        self.reference_check = None
 
         # Handle Property References
         for arg in self.request.arguments():
@@ -332,49 +904,371 @@ class SearchHandler(JsonHandler):
                 ref_prop_name = arg[4:]
                 ref_id = self.request.get(arg)
                 ref_prop = getattr(modelClass, ref_prop_name)
-                collection_name = ref_prop.collection_name
                 ref_class = ref_prop.data_type
-                instance = ref_class.get_by_id(int(ref_id))
-                if not instance:
-                    raise errors.ObjectMissingError("ReferenceProperty '{0}' with id {1} does not exist.".format(ref_prop_name, ref_id))
+                ref_key = db.Key.from_path(ref_class.kind(), int(ref_id))
+                self.reference_check = ModelFuture(
+                    db.get_async(ref_key),
+                    "ReferenceProperty '{0}' with id {1} does not exist.".format(ref_prop_name, ref_id))
 
-                query = getattr(instance, collection_name)
+                filters.append(('{0} ='.format(ref_prop_name), ref_key))
                 break
 
         # Parse other arguments
         for arg in self.request.arguments():
             match = QUERY_PATTERN.match(arg)
             if match:
-                next_page_querystring += "&{0}={1}".format(arg, self.request.get(arg))
                 query_type = match.group(1)
                 query_property = match.group(2)
                 operator = QUERY_EXPRS.get(query_type)
                 prop = modelClass._properties.get(query_property)
                 value = webapp2.get_app().converter._property_from_type(prop, self.request.get(arg))
-                query.filter(operator.format(query_property), value)
+                filters.append((operator.format(query_property), value))
                 continue
             if arg == 'order':
-                next_page_querystring += "&{0}={1}".format(arg, self.request.get(arg))
-                query.order(self.request.get(arg))
+                orders.append(self.request.get(arg))
                 continue
             if arg == 'cursor':
-                query.with_cursor(self.request.get(arg))
+                cursor = self.request.get(arg)
                 continue
             if arg == 'limit':
                 try:
                     limit = int(self.request.get(arg))
-                    next_page_querystring += "&{0}={1}".format(arg, self.request.get(arg))
                     continue
                 except ValueError:
                     raise errors.ApiFailureError('limit parameter must be an integer')
 
-        models = query.fetch(limit)
+        projected_fields = None
+        if projection and not keys_only:
+            projected_fields = self.projection_for(modelClass, set(self.list_argument('fields')), filters, orders)
+        if keys_only:
+            query = modelClass.all(keys_only=True)
+        elif projected_fields:
+            query = modelClass.all(projection=projected_fields)
+        else:
+            query = modelClass.all()
+        for expression, value in filters:
+            query.filter(expression, value)
+        for order in orders:
+            query.order(order)
+        if cursor:
+            query.with_cursor(cursor)
+
+        return query, self.next_page_arguments(), limit
+
+    def next_page_arguments(self):
+        """
+        Returns the request's filter, order, limit, expand, fields, keys_only
+        and budget arguments (everything but the cursor) needed to request the
+        next page, as a querystring in which every argument starts with "&".
+        """
+        querystring = ''
+        for arg in self.request.arguments():
+            if QUERY_PATTERN.match(arg) or arg in ('order', 'expand', 'fields', 'keys_only', 'budget'):
+                querystring += "&{0}={1}".format(arg, self.request.get(arg))
+            elif arg == 'limit':
+                try:
+                    int(self.request.get(arg))
+                except ValueError:
+                    continue
+                querystring += "&{0}={1}".format(arg, self.request.get(arg))
+        return querystring
+
+    def next_page_url(self, next_page_querystring, cursor):
+        """
+        Returns the URL of the page starting at cursor, given next_page_arguments().
+        """
+        querystring = (next_page_querystring + "&cursor=" + cursor)[1:]
+        return "{0}{1}?{2}".format(self.request.host_url, self.request.path, querystring)
+
+    def run_query(self, query, limit, batch_size=None):
+        """
+        Starts query, a query returned by build_query, and returns an iterator over its first limit results.
+        The query is started before waiting for the ref_ model check, so the two RPCs overlap.
+        """
+        results = query.run(limit=limit, batch_size=batch_size or limit, produce_cursors=bool(batch_size))
+        if self.reference_check:
+            self.reference_check.get_result()
+        return results
+
+    def budget(self):
+        """
+        Returns the time budget of this search in seconds, or None.
+        """
+        budget = self.request.get('budget')
+        if not budget:
+            return webapp2.get_app().search_budget
+        try:
+            return float(budget)
+        except ValueError:
+            raise errors.ApiFailureError('budget parameter must be a number of seconds')
+
+    def convert_models(self, models, keys_only, expand, fields):
+        """
+        Returns a list with the response dict of every model.
+        """
+        if keys_only:
+            return [{'id': key.id(), 'key': str(key)} for key in models]
+
+        converter = webapp2.get_app().converter
+        references = converter.prefetch_references(models, expand)
+        return [converter.read_model(model, expand=expand, references=references, fields=fields) for model in models]
+
+    def convert_keys(self, keys, keys_only, expand, fields):
+        """
+        Like convert_models, for the models with the given db.Keys, but returns
+        encoded JSON when the fragment cache is used (see usable_fragment_cache).
+        Models not found in the fragment cache are loaded with a single db.get();
+        models that no longer exist are left out.
+        """
+        if keys_only:
+            return self.convert_models(keys, keys_only, expand, fields)
+
+        cache = self.usable_fragment_cache(expand)
+        if cache:
+            return self.cached_fragments(cache, keys, fields, db.get)
+
+        models = [model for model in db.get(keys) if model is not None]
+        return self.convert_models(models, keys_only, expand, fields)
+
+    def cached_fragments(self, cache, keys, fields, load):
+        """
+        Returns the encoded JSON of the models with the given db.Keys, from
+        cache where possible. The others are loaded by load(keys), which returns
+        a list of models (or None for missing models), and added to the cache.
+        """
+        converter = webapp2.get_app().converter
+        variant = self.fragment_variant(fields)
+        fragments, versions = cache.lookup(keys, variant)
+        missing_keys = [key for key in keys if key not in fragments]
+        missing = {}
+        if missing_keys:
+            for key, model in zip(missing_keys, load(missing_keys)):
+                if model is not None:
+                    missing[key] = self.encode_json(converter.read_model(model, fields=fields))
+        cache.store(missing, versions, variant)
+        fragments.update(missing)
+        return [fragments[key] for key in keys if key in fragments]
+
+    def canonical_query(self):
+        """
+        Returns a string identifying the results selected by the request's
+        search arguments, however they are ordered or spelled.
+        """
+        parts = []
+        for arg in sorted(set(self.request.arguments())):
+            if arg == 'order':
+                # The sequence of sort orders matters.
+                parts.append(u'order=' + u','.join(self.request.get_all('order')))
+            elif arg == 'fields':
+                parts.append(u'fields=' + u','.join(sorted(set(self.list_argument('fields')))))
+            elif arg == 'keys_only':
+                parts.append(u'keys_only={0}'.format(bool(self.request.get('keys_only'))))
+            elif QUERY_PATTERN.match(arg) or arg.startswith('ref_') or arg in ('cursor', 'limit'):
+                parts.append(u'{0}={1}'.format(arg, self.request.get(arg)))
+        return u'&'.join(parts).encode('utf-8')
+
+    def query_kinds(self, modelClass):
+        """
+        Returns the kinds whose changes can change the results of the search:
+        the searched model's, and those of models named by ref_ arguments.
+        """
+        kinds = [modelClass.kind()]
+        for arg in self.request.arguments():
+            if arg.startswith('ref_'):
+                ref_prop = getattr(modelClass, arg[4:], None)
+                if isinstance(ref_prop, db.ReferenceProperty):
+                    kinds.append(ref_prop.data_type.kind())
+        return kinds
+
+    def read_within_budget(self, results, limit, budget, convert):
+        """
+        Reads and converts results in batches until limit results are read or
+        the next batch is not expected to finish within budget seconds.
+        Returns (items, partial) where partial is True if it stopped early.
+        """
+        deadline = time.time() + budget
+        items = []
+        while len(items) < limit:
+            started = time.time()
+            size = min(self.BUDGET_BATCH_SIZE, limit - len(items))
+            batch = list(itertools.islice(results, size))
+            items.extend(convert(batch))
+            if len(batch) < size:
+                return items, False
+            finished = time.time()
+            if len(items) < limit and finished + (finished - started) > deadline:
+                return items, True
+        return items, False
+
+    @authenticate
+    def get(self, model_name):
+        app = webapp2.get_app()
+        try:
+            modelClass = app.get_registered_model_type(model_name)
+        except TypeError:
+            raise errors.ModelNotRegisteredError(model_name)
+
+        data = {
+            'models': [],
+            'max_limit': app.max_page_size
+        }
+        expand = set(self.list_argument('expand'))
+        fields = set(self.list_argument('fields'))
+        keys_only = bool(self.request.get('keys_only'))
+        budget = self.budget()
+        if budget:
+            data['partial'] = False
+
+        query_cache = app.query_cache
+        if query_cache:
+            canonical = self.canonical_query()
+            kinds = self.query_kinds(modelClass)
+            page, generations = query_cache.lookup(kinds, canonical)
+            if page is not None:
+                # next_page depends on arguments left out of the canonical query, so it is built for this request.
+                (keys, data['cursor']) = page
+                if data['cursor']:
+                    data['next_page'] = self.next_page_url(self.next_page_arguments(), data['cursor'])
+                items = self.convert_keys([db.Key(key) for key in keys], keys_only, expand, fields)
+                self.write_search_page(data, items, keys_only, expand)
+                return
+
+        # Pages served from the fragment cache only need the keys of their models.
+        query_keys = keys_only or bool(self.usable_fragment_cache(expand))
+        query, next_page_querystring, limit = self.build_query(modelClass, keys_only=query_keys)
+        limit = min(limit, app.max_page_size)
+
+        page_keys = []
+
+        def convert(results):
+            if query_keys:
+                page_keys.extend(results)
+                return self.convert_keys(results, keys_only, expand, fields)
+            page_keys.extend(model.key() for model in results)
+            return self.convert_models(results, keys_only, expand, fields)
+
+        partial = False
+        for projection in (True, False):
+            if not projection:
+                # Projection queries on several properties need a composite index.
+                logging.warning('No index for projection of %s; running a full query instead', model_name)
+                query, next_page_querystring, _ = self.build_query(modelClass, projection=False, keys_only=query_keys)
+            try:
+                if budget:
+                    results = self.run_query(query, limit, min(limit, self.BUDGET_BATCH_SIZE))
+                    items, partial = self.read_within_budget(results, limit, budget, convert)
+                else:
+                    items = convert(list(self.run_query(query, limit)))
+                break
+            except db.NeedIndexError:
+                if not projection:
+                    raise
 
         data['cursor'] = None
-        if len(models) == limit:
+        if partial or len(page_keys) == limit:
+            # A budgeted query was read with cursors, so this is the position after the last item.
             data['cursor'] = query.cursor()
-            next_page_querystring += "&cursor=" + query.cursor()
-            data['next_page'] = "{0}{1}?{2}".format(self.request.host_url, self.request.path, next_page_querystring[1:])
-        for model in models:
-            data['models'].append(webapp2.get_app().converter.read_model(model))
-        self.api_success(data)
\ No newline at end of file
+            data['next_page'] = self.next_page_url(next_page_querystring, data['cursor'])
+        if budget:
+            data['partial'] = partial
+
+        if query_cache and not partial:
+            query_cache.store(canonical, generations, ([str(key) for key in page_keys], data['cursor']))
+        self.write_search_page(data, items, keys_only, expand)
+
+    def write_search_page(self, data, items, keys_only, expand):
+        """
+        Writes data with items (as returned by convert_keys) as its models.
+        """
+        if items and not keys_only and self.usable_fragment_cache(expand):
+            data['models'] = [FRAGMENT_PLACEHOLDER]
+            self.api_success_fragments(data, items)
+        else:
+            data['models'] = items
+            self.api_success(data)
+
+
+class ExportHandler(SearchHandler):
+    """
+    Streams every model matching a search as newline-delimited JSON
+    (http://ndjson.org), without paging.
+
+    Usage: HTTP GET to /rest/ModelName/export
+    Returns one line per model, in the format of SearchHandler's models,
+    followed by a trailer line:
+        {"cursor": cursor, "count": count}
+
+        cursor: when the export stopped at "limit", the cursor to pass back to
+            export (or search) to resume; null when every model was exported.
+        count: the number of models exported.
+
+    Querystring Parameters:
+        Filter Expression, Sort Order, Cursor, Expanded References and Fields as for SearchHandler.
+
+        Limit:
+            Querystring name: "limit"
+            Querystring value: maximum number of models to export. Unlimited by default.
+
+        Batch Size:
+            Querystring name: "batch_size"
+            Querystring value: number of models fetched from the datastore (and
+                written to the response) at a time. Defaults to 100.
+
+    Models are converted and written one batch at a time, so memory use does
+    not grow with the size of the export.
+    """
+    DEFAULT_BATCH_SIZE = 100
+
+    @authenticate
+    def get(self, model_name):
+        app = webapp2.get_app()
+        modelClass = app.get_registered_model_type(model_name)
+        expand = set(self.list_argument('expand'))
+        fields = set(self.list_argument('fields'))
+        # Projections on several properties need a composite index, and a missing
+        # one would only be noticed after the response has started streaming.
+        query, _, limit = self.build_query(modelClass, limit=None, projection=False)
+        try:
+            batch_size = int(self.request.get('batch_size') or self.DEFAULT_BATCH_SIZE)
+        except ValueError:
+            raise errors.ApiFailureError('batch_size parameter must be an integer')
+        if self.reference_check:
+            self.reference_check.get_result()
+
+        self.response.headers['Content-Type'] = 'application/x-ndjson; charset=utf-8'
+        lines = self.export_lines(app, query, limit, batch_size, expand, fields)
+        level = self.gzip_level()
+        if level:
+            self.response.headers['Content-Encoding'] = 'gzip'
+            lines = gzip_iter(lines, level)
+        self.response.app_iter = self.timed_body(lines)
+
+    def encode_lines(self, app, models, expand, fields):
+        references = app.converter.prefetch_references(models, expand)
+        return ''.join(app.json_codec.dumps(app.converter.read_model(model, expand=expand, references=references, fields=fields)) + '\n'
+                       for model in models)
+
+    def export_lines(self, app, query, limit, batch_size, expand, fields):
+        """
+        Generator producing the response body. It runs after the handler has
+        returned, so it restores the webapp2 globals the converter relies on.
+        """
+        app.set_globals(app=app, request=self.request)
+        try:
+            count = 0
+            batch = []
+            for model in query.run(batch_size=batch_size, limit=limit):
+                batch.append(model)
+                count += 1
+                if len(batch) == batch_size:
+                    yield self.encode_lines(app, batch, expand, fields)
+                    batch = []
+            if batch:
+                yield self.encode_lines(app, batch, expand, fields)
+
+            cursor = None
+            if limit and count == limit:
+                cursor = query.cursor()
+            yield app.json_codec.dumps({'cursor': cursor, 'count': count}) + '\n'
+        finally:
+            app.clear_globals()
@@ -0,0 +1,81 @@
+"""
+JSON encoder/decoder backends used by JSONApplication.
+
+best_available_codec() picks the fastest backend that is installed:
+ujson, then simplejson with its C speedups, then the standard library json
+module. All backends encode compactly unless an indent is requested.
+"""
+__author__ = 'Brian'
+import json
+
+
+class JsonCodec(object):
+    """
+    Base class for JSON backends. Encodes and decodes with module, which
+    must have the standard library json interface; backends with another
+    interface override dumps() and loads().
+    """
+    name = None
+    module = json
+
+    def dumps(self, obj, indent=None):
+        if indent:
+            return self.module.dumps(obj, indent=indent)
+        return self.module.dumps(obj, separators=(',', ':'))
+
+    def loads(self, s):
+        return self.module.loads(s)
+
+
+class StdlibCodec(JsonCodec):
+    name = 'json'
+
+
+class SimplejsonCodec(JsonCodec):
+    """
+    simplejson, only used when its C speedups are available.
+    """
+    name = 'simplejson'
+
+    def __init__(self):
+        import simplejson
+        from simplejson import _speedups
+        self.module = simplejson
+
+
+class UjsonCodec(JsonCodec):
+    name = 'ujson'
+
+    def __init__(self):
+        import ujson
+        self.ujson = ujson
+        # Older ujson releases round floats; only use ujson when it round-trips them.
+        value = 0.1 + 0.2
+        if ujson.loads(self.dumps(value)) != value:
+            raise ImportError('ujson {0} does not round-trip floats'.format(getattr(ujson, '__version__', '')))
+
+    def dumps(self, obj, indent=None):
+        return self.ujson.dumps(obj, indent=indent or 0, escape_forward_slashes=False)
+
+    def loads(self, s):
+        return self.ujson.loads(s)
+
+
+CODECS = [UjsonCodec, SimplejsonCodec, StdlibCodec]
+
+
+def available_codecs():
+    """
+    Returns an instance of every installed codec, fastest first.
+    """
+    codecs = []
+    for codec_class in CODECS:
+        try:
+            codecs.append(codec_class())
+        except ImportError:
+            pass
+    return codecs
+
+
+def best_available_codec():
+    return available_codecs()[0]
@@ -0,0 +1,122 @@
+"""
+Opt-in profiling of individual requests, used by JSONApplication(profile_policy=...).
+
+The application's router dispatcher is replaced so that requests selected by
+the ProfilePolicy run every handler under cProfile. Handlers are unchanged.
+"""
+__author__ = 'Brian'
+import cProfile
+import logging
+import pstats
+import random
+import time
+from webapp2 import Router
+
+import errors
+import handlers
+
+
+def memory_usage_mb():
+    """
+    Returns the instance's current memory usage in megabytes, or None where it is not available.
+    """
+    try:
+        from google.appengine.api import runtime
+        return runtime.memory_usage().current()
+    except Exception:
+        return None
+
+
+class ProfilePolicy(object):
+    """
+    Chooses which requests to profile, and what to do with the results.
+
+    Arguments:
+        sample_rate: fraction (0 to 1) of requests profiled at random.
+        allow_param: profile requests with the querystring argument "_profile=1",
+            if the request passes the application's auth_func (when it has one).
+        predicate: optional function taking a webapp2.Request and returning True
+            to profile it.
+        top: number of functions reported, by cumulative time.
+        attach: also return the report to the client in the X-Profile response header.
+
+    Reports are logged at INFO level as a JSON object:
+        {"method", "path", "status", "duration_ms", "memory_delta_mb",
+         "top": [{"function", "calls", "total_ms", "cumulative_ms"}]}
+    memory_delta_mb is null where the runtime API is not available.
+    """
+    def __init__(self, sample_rate=0.0, allow_param=False, predicate=None, top=20, attach=False):
+        self.sample_rate = sample_rate
+        self.allow_param = allow_param
+        self.predicate = predicate
+        self.top = top
+        self.attach = attach
+
+    def should_profile(self, app, request):
+        if self.predicate and self.predicate(request):
+            return True
+        if self.allow_param and request.get('_profile') == '1':
+            return self.authorized(app, request)
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    @staticmethod
+    def authorized(app, request):
+        if not app.authenticator:
+            return True
+        try:
+            handlers.run_authenticator(app, request)
+        except (errors.AuthenticationRequiredError, errors.ForbiddenError):
+            return False
+        return True
+
+    def top_functions(self, profiler):
+        stats = pstats.Stats(profiler)
+        rows = []
+        for (filename, line, name), (_, calls, total, cumulative, _) in stats.stats.iteritems():
+            rows.append((cumulative, {
+                'function': '{0}:{1}({2})'.format(filename, line, name),
+                'calls': calls,
+                'total_ms': round(1000 * total, 3),
+                'cumulative_ms': round(1000 * cumulative, 3),
+            }))
+        rows.sort(key=lambda row: row[0], reverse=True)
+        return [row[1] for row in rows[:self.top]]
+
+    def report(self, request, response, profiler, duration, memory_delta):
+        report = {
+            'method': request.method,
+            'path': request.path_qs,
+            'status': response.status_int,
+            'duration_ms': round(1000 * duration, 3),
+            'memory_delta_mb': memory_delta,
+            'top': self.top_functions(profiler),
+        }
+        encoded = request.app.json_codec.dumps(report)
+        logging.info('Request profile: %s', encoded)
+        if self.attach:
+            response.headers['X-Profile'] = encoded
+        return report
+
+
+def install(app, policy):
+    """
+    Replaces app's router dispatcher with one profiling the requests chosen by policy.
+    """
+    def dispatcher(router, request, response):
+        if not policy.should_profile(app, request):
+            return Router.default_dispatcher(router, request, response)
+
+        memory_before = memory_usage_mb()
+        profiler = cProfile.Profile()
+        start = time.time()
+        try:
+            return profiler.runcall(Router.default_dispatcher, router, request, response)
+        finally:
+            duration = time.time() - start
+            memory_after = memory_usage_mb()
+            memory_delta = None
+            if memory_before is not None and memory_after is not None:
+                memory_delta = memory_after - memory_before
+            policy.report(request, response, profiler, duration, memory_delta)
+
+    app.router.set_dispatcher(dispatcher)
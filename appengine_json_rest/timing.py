@@ -0,0 +1,277 @@
+"""
+Per-request timing: phase timers, datastore RPC counts and in-memory
+per-route histograms, used by JSONApplication(timing=True).
+
+A RequestTimer is active for the duration of each request (see
+handlers.JsonHandler.dispatch). Code times a phase with
+
+    with timing.phase('encode'):
+        ...
+
+or by decorating a function with @timing.timed('convert'). Both cost a
+thread-local lookup when no timer is active. Datastore RPCs are counted and
+timed by App Engine API proxy hooks.
+"""
+__author__ = 'Brian'
+import bisect
+import functools
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+
+
+_local = threading.local()
+
+HOOK_NAME = 'appengine_json_rest_timing'
+
+# Upper bounds, in milliseconds, of the latency histogram buckets; the last bucket is unbounded.
+BUCKET_BOUNDS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]
+
+
+class RequestTimer(object):
+    """
+    Accumulates the time spent in named phases of one request, and its datastore RPCs.
+    Phases may overlap (e.g. datastore RPCs made while converting).
+    """
+    def __init__(self):
+        self.start = time.time()
+        self.total = None
+        self.phases = {}
+        self.rpcs = {}
+        self.__active = set()
+        self.__rpc_starts = {}
+
+    def add(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def rpc_started(self, call, rpc):
+        self.rpcs[call] = self.rpcs.get(call, 0) + 1
+        self.__rpc_starts[id(rpc)] = time.time()
+
+    def rpc_finished(self, rpc):
+        started = self.__rpc_starts.pop(id(rpc), None)
+        if started is not None:
+            self.add('datastore', time.time() - started)
+
+    def enter(self, name):
+        """
+        Returns the start time of phase name, or None if it is already being
+        timed further up the stack (so that recursive calls are not counted twice).
+        """
+        if name in self.__active:
+            return None
+        self.__active.add(name)
+        return time.time()
+
+    def exit(self, name, started):
+        if started is not None:
+            self.__active.discard(name)
+            self.add(name, time.time() - started)
+
+    def stop(self):
+        self.total = time.time() - self.start
+        return self.total
+
+    def rpc_count(self):
+        return sum(self.rpcs.itervalues())
+
+    def server_timing(self):
+        """
+        Returns the value of a Server-Timing header (https://www.w3.org/TR/server-timing/) for this request.
+        """
+        entries = []
+        for name in sorted(self.phases):
+            entry = '{0};dur={1:.1f}'.format(name, 1000 * self.phases[name])
+            if name == 'datastore':
+                entry += ';desc="{0} RPCs"'.format(self.rpc_count())
+            entries.append(entry)
+        if self.total is not None:
+            entries.append('total;dur={0:.1f}'.format(1000 * self.total))
+        return ', '.join(entries)
+
+
+def _before_rpc(service, call, request, response, rpc):
+    timer = getattr(_local, 'timer', None)
+    if timer is not None:
+        timer.rpc_started(call, rpc)
+
+
+def _after_rpc(service, call, request, response, rpc, error):
+    # Taking error means the hook is also called for failed RPCs.
+    timer = getattr(_local, 'timer', None)
+    if timer is not None:
+        timer.rpc_finished(rpc)
+
+
+def install_hooks():
+    """
+    Installs the datastore RPC hooks on the current API proxy, unless already installed.
+    (The testbed replaces the API proxy, so this is checked for every request.)
+    """
+    apiproxy = apiproxy_stub_map.apiproxy
+    apiproxy.GetPreCallHooks().Append(HOOK_NAME, _before_rpc, 'datastore_v3')
+    apiproxy.GetPostCallHooks().Append(HOOK_NAME, _after_rpc, 'datastore_v3')
+
+
+def start():
+    """
+    Starts timing the current thread's request and returns its RequestTimer.
+    """
+    install_hooks()
+    timer = RequestTimer()
+    _local.timer = timer
+    return timer
+
+
+def resume(timer):
+    """
+    Makes timer, returned by start() and stopped by finish(), time the current thread's request again.
+    """
+    install_hooks()
+    _local.timer = timer
+
+
+def finish():
+    """
+    Stops timing the current thread's request and returns its RequestTimer, or None.
+    """
+    timer = getattr(_local, 'timer', None)
+    _local.timer = None
+    if timer is not None:
+        timer.stop()
+    return timer
+
+
+def current():
+    return getattr(_local, 'timer', None)
+
+
+class phase(object):
+    """
+    Context manager timing a phase of the current request, if it is being timed.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.timer = None
+        self.started = None
+
+    def __enter__(self):
+        self.timer = getattr(_local, 'timer', None)
+        if self.timer is not None:
+            self.started = self.timer.enter(self.name)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.timer is not None:
+            self.timer.exit(self.name, self.started)
+        return False
+
+
+def timed(name):
+    """
+    Decorator timing every call of the decorated function as phase name.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def decorated(*args, **kwargs):
+            timer = getattr(_local, 'timer', None)
+            if timer is None:
+                return function(*args, **kwargs)
+            started = timer.enter(name)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                timer.exit(name, started)
+        return decorated
+    return decorator
+
+
+class Histogram(object):
+    """
+    Request count, latency histogram and mean phase times and RPC counts of one route and model.
+    """
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.buckets = [0] * (len(BUCKET_BOUNDS_MS) + 1)
+        self.phases = {}
+        self.rpcs = 0
+
+    def add(self, timer):
+        self.count += 1
+        self.total += timer.total
+        self.buckets[bisect.bisect_left(BUCKET_BOUNDS_MS, 1000 * timer.total)] += 1
+        for name, seconds in timer.phases.iteritems():
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+        self.rpcs += timer.rpc_count()
+
+    def percentile_ms(self, p):
+        """
+        Returns the upper bound of the bucket holding the p-th percentile (None for the unbounded bucket).
+        """
+        rank = p / 100.0 * self.count
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return BUCKET_BOUNDS_MS[i] if i < len(BUCKET_BOUNDS_MS) else None
+        return None
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean_ms': 1000 * self.total / self.count,
+            'p50_ms': self.percentile_ms(50),
+            'p95_ms': self.percentile_ms(95),
+            'p99_ms': self.percentile_ms(99),
+            'mean_rpcs': float(self.rpcs) / self.count,
+            'mean_phase_ms': dict((name, 1000 * seconds / self.count) for name, seconds in self.phases.iteritems()),
+            'buckets_ms': dict((str(bound), count) for bound, count in zip(BUCKET_BOUNDS_MS + ['inf'], self.buckets)),
+        }
+
+
+class TimingStats(object):
+    """
+    Thread-safe in-memory histograms of request timings, per route and model.
+    Percentiles are bucket upper bounds, in milliseconds.
+
+    At most max_keys routes and models are kept apart; requests for any further
+    ones are recorded together under route OVERFLOW_ROUTE.
+    """
+    OVERFLOW_ROUTE = 'other'
+
+    def __init__(self, max_keys=200):
+        self.max_keys = max_keys
+        self.__lock = threading.Lock()
+        self.__histograms = {}
+
+    def record(self, route, model_name, timer):
+        key = (route, model_name)
+        with self.__lock:
+            histogram = self.__histograms.get(key)
+            if histogram is None:
+                if len(self.__histograms) >= self.max_keys:
+                    key = (self.OVERFLOW_ROUTE, None)
+                    histogram = self.__histograms.get(key)
+                if histogram is None:
+                    histogram = Histogram()
+                    self.__histograms[key] = histogram
+            histogram.add(timer)
+
+    def snapshot(self):
+        """
+        Returns a list of dicts, one per route and model, sorted by route and model.
+        """
+        with self.__lock:
+            result = []
+            for (route, model_name), histogram in sorted(self.__histograms.iteritems()):
+                summary = histogram.summary()
+                summary['route'] = route
+                summary['model'] = model_name
+                result.append(summary)
+            return result
+
+    def reset(self):
+        with self.__lock:
+            self.__histograms = {}
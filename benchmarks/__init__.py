@@ -0,0 +1,76 @@
+"""
+In-process benchmarks for appengine_json_rest.
+
+The benchmarks run JSONApplication through WSGI against the App Engine SDK's
+in-memory datastore stub, so the SDK (and the webapp2 it bundles) must be
+importable. Run them from the directory containing this checkout, e.g.:
+    python -m appengine_json_rest.benchmarks.bench_fragment_cache
+
+benchmarks.suite runs the standard set of benchmarks and compares them
+against a saved baseline.
+"""
+import time
+import webapp2
+from google.appengine.ext import testbed
+
+
+__author__ = 'Brian'
+
+
+def activate_testbed():
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.init_datastore_v3_stub()
+    bed.init_memcache_stub()
+    return bed
+
+
+def call(app, path, method='GET', body=None, headers=None):
+    request = webapp2.Request.blank(path, headers=headers)
+    request.method = method
+    if body is not None:
+        request.body = body
+    return request.get_response(app)
+
+
+def measure(fn, iterations):
+    """
+    Calls fn iterations times and returns the duration of each call, in seconds.
+    """
+    timings = []
+    for _ in range(iterations):
+        start = time.time()
+        fn()
+        timings.append(time.time() - start)
+    return timings
+
+
+def percentile(timings, p):
+    """
+    Returns the p-th percentile (0-100) of timings, using the nearest-rank method.
+    """
+    ordered = sorted(timings)
+    rank = int(round(p / 100.0 * len(ordered) + 0.5)) - 1
+    return ordered[max(0, min(len(ordered) - 1, rank))]
+
+
+def summarize(timings):
+    """
+    Returns a dict of ops_per_sec, and of p50_ms and p99_ms latencies.
+    """
+    total = sum(timings)
+    return {
+        'ops_per_sec': len(timings) / total if total else float('inf'),
+        'p50_ms': 1000.0 * percentile(timings, 50),
+        'p99_ms': 1000.0 * percentile(timings, 99),
+    }
+
+
+def report(name, timings):
+    """
+    Prints and returns the summary of timings.
+    """
+    summary = summarize(timings)
+    print('{0:<40} {1:>10.1f} ops/sec  p50 {2:>8.3f} ms  p99 {3:>8.3f} ms'.format(
+        name, summary['ops_per_sec'], summary['p50_ms'], summary['p99_ms']))
+    return summary
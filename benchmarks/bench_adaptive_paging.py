@@ -0,0 +1,67 @@
+"""
+Scans a simulated search API with fixed page sizes and with adaptive paging
+(Query.adaptive), reporting total scan time, request count and the slowest page.
+
+The simulated server charges a fixed round-trip cost per request plus a cost
+per model, so small pages are dominated by round-trips and large pages by
+long requests that risk hitting the request deadline.
+"""
+import time
+import urlparse
+from appengine_json_rest.clients.py import Query
+
+
+ROUND_TRIP_SECONDS = 0.02
+MODEL_SECONDS = 0.0002
+MAX_LIMIT = 1000
+
+
+class SimulatedClient(object):
+    def __init__(self, model_count):
+        self.model_count = model_count
+        self.requests = 0
+        self.slowest = 0.0
+
+    def search_page(self, querystring):
+        args = dict(urlparse.parse_qsl(querystring))
+        limit = min(int(args.get('limit', 20)), MAX_LIMIT)
+        offset = int(args.get('cursor', 0))
+        models = [{'id': i, 'name': 'fruit{0}'.format(i), 'width': i}
+                  for i in range(offset, min(offset + limit, self.model_count))]
+
+        seconds = ROUND_TRIP_SECONDS + MODEL_SECONDS * len(models)
+        time.sleep(seconds)
+        self.requests += 1
+        self.slowest = max(self.slowest, seconds)
+
+        cursor = None
+        if len(models) == limit:
+            cursor = str(offset + limit)
+        return {'models': models, 'cursor': cursor, 'max_limit': MAX_LIMIT}
+
+
+def scan(name, query_factory, model_count, limit=None):
+    client = SimulatedClient(model_count)
+    query = query_factory(client)
+    start = time.time()
+    count = 0
+    models = query.fetch(limit)
+    while models:
+        count += len(models)
+        models = query.fetch()
+    total = time.time() - start
+    assert count == model_count, (name, count)
+    print('{0:<40} {1:>8.3f} s  {2:>5} requests  {3:>8.1f} ms slowest page'.format(
+        name, total, client.requests, 1000 * client.slowest))
+
+
+def run(model_count=5000):
+    for limit in (20, 100, 500, 1000):
+        scan('fixed limit={0}'.format(limit), Query, model_count, limit)
+    for target in (0.05, 0.1):
+        scan('adaptive target={0}s'.format(target), lambda client: Query(client).adaptive(target_seconds=target),
+             model_count)
+
+
+if __name__ == '__main__':
+    run()
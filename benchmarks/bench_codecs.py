@@ -0,0 +1,39 @@
+"""
+Encodes a typical 200-model search page with every installed JSON codec.
+"""
+from appengine_json_rest.appengine_json_rest import jsoncodec
+from appengine_json_rest.benchmarks import measure, report
+
+
+def search_page(model_count=200):
+    models = []
+    for i in range(model_count):
+        models.append({
+            'key': 'agxkZXZ-c2FtcGxlc3IMCxIFRnJ1aXQY{0:06d}DA'.format(i),
+            'id': i,
+            'name': u'fruit{0}'.format(i),
+            'width': i,
+            'created_datetime': '2012-01-03T15:32:00.250000',
+            'location': {'lat': 22.3, 'lon': 13.0},
+            'touched_dates': ['2012-01-03T15:32:00', '2012-01-04T17:01:16', '2012-01-07T00:01:02'],
+            'basket': {
+                'model': 'Basket',
+                'module': 'models',
+                'id': i % 5,
+                'key': 'agxkZXZ-c2FtcGxlc3ILCxIGQmFza2V0GAEM',
+                'url': 'http://localhost:8080/rest/Basket/{0}'.format(i % 5)
+            },
+        })
+    return {'status': 'success', 'data': {'models': models, 'cursor': 'E-ABAIICHmoMZGV2fnNhbXBsZXNyDgsSBUZydWl0GNIPDBQ'}}
+
+
+def run(iterations=200):
+    page = search_page()
+    for codec in jsoncodec.available_codecs():
+        report('{0} dumps'.format(codec.name), measure(lambda: codec.dumps(page), iterations))
+        encoded = codec.dumps(page)
+        report('{0} loads'.format(codec.name), measure(lambda: codec.loads(encoded), iterations))
+
+
+if __name__ == '__main__':
+    run()
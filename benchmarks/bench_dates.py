@@ -0,0 +1,27 @@
+"""
+Compares the fast ISO 8601 parsing path in converter.py with dateutil.
+"""
+from dateutil import parser as date_parser
+from appengine_json_rest.appengine_json_rest import converter
+from appengine_json_rest.benchmarks import measure, report
+
+
+SAMPLES = [
+    '2012-01-03T15:32:00',
+    '2012-01-04T17:01:16.250000',
+    '2012-01-07',
+]
+
+
+def run(iterations=20000):
+    def parse_all(fn):
+        return lambda: [fn(sample) for sample in SAMPLES]
+
+    report('dateutil.parser.parse', measure(parse_all(date_parser.parse), iterations))
+    report('converter.to_datetime', measure(parse_all(converter.to_datetime), iterations))
+    report('converter.to_date', measure(parse_all(converter.to_date), iterations))
+    report('converter.to_time', measure(parse_all(converter.to_time), iterations))
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,35 @@
+"""
+Read-heavy workloads (90% single model reads and 10% search pages, then
+search pages only) with and without a FragmentCache.
+"""
+import random
+from appengine_json_rest.appengine_json_rest.application import JSONApplication
+from appengine_json_rest.appengine_json_rest.cache import FragmentCache, LRUCache
+from appengine_json_rest.benchmarks import activate_testbed, call, measure, report
+from appengine_json_rest.benchmarks.models import MODELS, create_fruits
+
+
+def run(model_count=100, iterations=2000):
+    bed = activate_testbed()
+    try:
+        ids = [key.id() for key in create_fruits(model_count)]
+        for workload, search_share in (('mixed', 0.1), ('search only', 1.0)):
+            for name, cache in (('no fragment cache', None), ('LRU fragment cache', FragmentCache(LRUCache()))):
+                app = JSONApplication('rest', models=MODELS, fragment_cache=cache)
+                rng = random.Random(0)
+
+                def read():
+                    if rng.random() < search_share:
+                        call(app, '/rest/Fruit/search?limit=20')
+                    else:
+                        call(app, '/rest/Fruit/{0}'.format(rng.choice(ids)))
+
+                report('{0}, {1}'.format(workload, name), measure(read, iterations))
+                if cache:
+                    print('    {0}'.format(cache.stats()))
+    finally:
+        bed.deactivate()
+
+
+if __name__ == '__main__':
+    run()
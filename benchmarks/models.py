@@ -0,0 +1,36 @@
+import datetime
+from google.appengine.ext import db
+
+
+__author__ = 'Brian'
+
+
+class Basket(db.Model):
+    location = db.GeoPtProperty()
+
+
+class Fruit(db.Model):
+    name = db.StringProperty()
+    width = db.IntegerProperty()
+    created_datetime = db.DateTimeProperty(auto_now_add=True)
+    location = db.GeoPtProperty()
+    touched_dates = db.ListProperty(datetime.datetime)
+    basket = db.ReferenceProperty(Basket, collection_name='fruits')
+
+
+MODELS = [Basket, Fruit]
+
+
+def create_fruits(count):
+    """
+    Stores count Fruit models spread over a few Baskets and returns their keys.
+    """
+    baskets = [Basket(location=db.GeoPt(i, i)) for i in range(5)]
+    db.put(baskets)
+    now = datetime.datetime(2012, 1, 3, 15, 32)
+    fruits = []
+    for i in range(count):
+        fruits.append(Fruit(name='fruit{0}'.format(i), width=i, location=db.GeoPt(22.3, 13.0),
+                            touched_dates=[now + datetime.timedelta(days=d) for d in range(3)],
+                            basket=baskets[i % len(baskets)]))
+    return db.put(fruits)
@@ -0,0 +1,143 @@
+"""
+Standard benchmark suite: converter reads and creates, model requests,
+search pages of several sizes, metadata, and authentication overhead.
+
+Each result is reported as ops/sec with p50/p99 latencies. Results are
+compared against a baseline saved by an earlier run on the same machine;
+the run fails (exit status 1) when a benchmark's ops/sec dropped by more
+than the tolerance, and exits with status 2 when there is no baseline to
+compare against, so that a check cannot pass without one.
+
+    python -m appengine_json_rest.benchmarks.suite --save-baseline
+    # ... change things ...
+    python -m appengine_json_rest.benchmarks.suite
+"""
+import argparse
+import json
+import os
+import sys
+import webapp2
+from appengine_json_rest.appengine_json_rest.application import JSONApplication
+from appengine_json_rest.appengine_json_rest.cache import AuthCache
+from appengine_json_rest.appengine_json_rest import errors
+from appengine_json_rest.benchmarks import activate_testbed, call, measure, report
+from appengine_json_rest.benchmarks.models import MODELS, Fruit, create_fruits
+
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+TOKEN = 'Bearer benchmark'
+
+
+def auth_func(request):
+    if request.headers.get('Authorization') != TOKEN:
+        raise errors.AuthenticationRequiredError()
+
+
+def benchmarks(ids):
+    """
+    Returns a list of (name, function, iterations_divisor) tuples.
+    Benchmarks that create models come last, so they do not change what the others read.
+    """
+    app = JSONApplication('rest', models=MODELS)
+    auth_app = JSONApplication('rest', models=MODELS, auth_func=auth_func)
+    cached_auth_app = JSONApplication('rest', models=MODELS, auth_func=auth_func, auth_cache=AuthCache())
+    auth_headers = {'Authorization': TOKEN}
+    model_path = '/rest/Fruit/{0}'.format(ids[0])
+    model = Fruit.get_by_id(ids[0])
+    values = {'name': 'created', 'width': 3, 'touched_dates': ['2012-01-03T15:32:00', '2012-01-04T17:01:16']}
+
+    def with_globals(fn):
+        def wrapper():
+            app.set_globals(app=app, request=webapp2.Request.blank('/'))
+            try:
+                fn()
+            finally:
+                app.clear_globals()
+        return wrapper
+
+    return [
+        ('converter read_model', with_globals(lambda: app.converter.read_model(model)), 1),
+        ('GET model', lambda: call(app, model_path), 1),
+        ('search limit=20', lambda: call(app, '/rest/Fruit/search?limit=20'), 1),
+        ('search limit=100', lambda: call(app, '/rest/Fruit/search?limit=100'), 5),
+        ('search limit=500', lambda: call(app, '/rest/Fruit/search?limit=500'), 20),
+        ('metadata', lambda: call(app, '/rest/metadata'), 1),
+        ('metadata Fruit', lambda: call(app, '/rest/metadata/Fruit'), 1),
+        ('GET model with auth_func', lambda: call(auth_app, model_path, headers=auth_headers), 1),
+        ('GET model with auth_func and AuthCache', lambda: call(cached_auth_app, model_path, headers=auth_headers), 1),
+        ('converter create_model', with_globals(lambda: app.converter.create_model(Fruit, values)), 1),
+        ('POST model', lambda: call(app, '/rest/Fruit', 'POST', json.dumps(values)), 1),
+    ]
+
+
+def run(iterations=500, model_count=600, only=None):
+    """
+    Runs the benchmarks whose name contains only (or all of them) and returns a dict of name to summary.
+    """
+    bed = activate_testbed()
+    try:
+        ids = [key.id() for key in create_fruits(model_count)]
+        results = {}
+        for name, fn, divisor in benchmarks(ids):
+            if only and only not in name:
+                continue
+            fn()  # warm up plans, metadata documents and caches
+            results[name] = report(name, measure(fn, max(1, iterations // divisor)))
+        return results
+    finally:
+        bed.deactivate()
+
+
+def compare(results, baseline, tolerance):
+    """
+    Prints the change of every result against baseline and returns the names
+    of the benchmarks whose ops/sec dropped by more than tolerance (a fraction).
+    """
+    regressions = []
+    print('')
+    for name in sorted(results):
+        if name not in baseline:
+            print('{0:<40} (not in baseline)'.format(name))
+            continue
+        before = baseline[name]['ops_per_sec']
+        after = results[name]['ops_per_sec']
+        change = (after - before) / before if before else 0.0
+        flag = ''
+        if change < -tolerance:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print('{0:<40} {1:>+8.1%} ops/sec  p99 {2:>8.3f} -> {3:>8.3f} ms{4}'.format(
+            name, change, baseline[name]['p99_ms'], results[name]['p99_ms'], flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--iterations', type=int, default=500)
+    parser.add_argument('--only', help='only run benchmarks whose name contains this')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='save the results as the new baseline instead of comparing against it')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='largest acceptable drop in ops/sec, as a fraction (default 0.2)')
+    args = parser.parse_args(argv)
+
+    results = run(args.iterations, only=args.only)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print('Saved baseline to {0}'.format(args.baseline))
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print('No baseline at {0}; run with --save-baseline first.'.format(args.baseline))
+        return 2
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if compare(results, baseline, args.tolerance):
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
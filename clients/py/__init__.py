@@ -1,8 +1,17 @@
 import urllib
-import urllib2
+import urlparse
+import httplib
 import json
 import base64
+import collections
+import Queue
 import re
+import select
+import socket
+import threading
+import time
+import zlib
+from multiprocessing.pool import ThreadPool
 
 
 class QueryLockedError(Exception):
@@ -10,7 +19,14 @@ class QueryLockedError(Exception):
 
 
 class ApiCallFailedError(Exception):
-    pass
+    """
+    Raised for a failed API call. status is the HTTP status and body the
+    response body, when the server responded.
+    """
+    def __init__(self, message, status=None, body=None):
+        super(ApiCallFailedError, self).__init__(message)
+        self.status = status
+        self.body = body
 
 
 class ObjectMissingError(Exception):
@@ -29,6 +45,185 @@ class OperatorNotFoundError(Exception):
     pass
 
 
+class ConnectionPool(object):
+    """
+    Thread-safe pool of persistent (keep-alive) httplib connections, keyed by
+    scheme and host.
+
+    At most max_per_host requests run at once against each host; further
+    requests wait for a connection to be returned. Idle connections the
+    server has already closed are discarded when they are checked out.
+
+    A request made on a reused connection that the server has since closed is
+    retried on a new one, but only when no part of a response was received and
+    the request could not have taken effect twice: idempotent methods are
+    retried, other methods only when sending the request itself failed.
+    Timeouts are never retried.
+    """
+    IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS'])
+    MAX_PER_HOST = 4
+
+    def __init__(self, max_per_host=MAX_PER_HOST, timeout=None):
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self.__lock = threading.Lock()
+        self.__idle = {}
+        self.__slots = {}
+
+    def __slot(self, host_key):
+        with self.__lock:
+            slot = self.__slots.get(host_key)
+            if slot is None:
+                slot = threading.BoundedSemaphore(self.max_per_host)
+                self.__slots[host_key] = slot
+            return slot
+
+    @staticmethod
+    def __dropped(connection):
+        """
+        Returns whether the server has closed idle connection (its socket is readable at end of file).
+        """
+        if connection.sock is None:
+            return True
+        try:
+            return bool(select.select([connection.sock], [], [], 0)[0])
+        except (select.error, socket.error, ValueError):
+            return True
+
+    def __checkout(self, host_key):
+        """
+        Returns (connection, reused).
+        """
+        while True:
+            with self.__lock:
+                idle = self.__idle.get(host_key)
+                if not idle:
+                    break
+                connection = idle.pop()
+            if not self.__dropped(connection):
+                return connection, True
+            connection.close()
+
+        (scheme, host) = host_key
+        if scheme == 'https':
+            return httplib.HTTPSConnection(host, timeout=self.timeout), False
+        return httplib.HTTPConnection(host, timeout=self.timeout), False
+
+    def __checkin(self, host_key, connection):
+        with self.__lock:
+            self.__idle.setdefault(host_key, []).append(connection)
+
+    def __stale(self, reused, method, sent, error):
+        """
+        Returns whether error, raised before a response status was received,
+        means a reused connection had been closed and the request can be retried.
+        """
+        if not reused or isinstance(error, socket.timeout):
+            return False
+        return method in self.IDEMPOTENT_METHODS or not sent
+
+    def request(self, method, url, body=None, headers=None):
+        """
+        Makes an HTTP request and returns (status, response_headers, response_body).
+        response_headers is an httplib.HTTPMessage.
+        """
+        parts = urlparse.urlsplit(url)
+        host_key = (parts.scheme, parts.netloc)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        slot = self.__slot(host_key)
+        slot.acquire()
+        try:
+            while True:
+                (connection, reused) = self.__checkout(host_key)
+                sent = False
+                try:
+                    connection.request(method, path, body, headers or {})
+                    sent = True
+                    response = connection.getresponse()
+                except (httplib.HTTPException, socket.error) as e:
+                    connection.close()
+                    if self.__stale(reused, method, sent, e):
+                        # The server closed this keep-alive connection; retry on a new one.
+                        continue
+                    raise
+                try:
+                    response_body = response.read()
+                except (httplib.HTTPException, socket.error):
+                    connection.close()
+                    raise
+
+                if response.will_close:
+                    connection.close()
+                else:
+                    self.__checkin(host_key, connection)
+                return response.status, response.msg, response_body
+        finally:
+            slot.release()
+
+    def close(self):
+        with self.__lock:
+            for connections in self.__idle.itervalues():
+                for connection in connections:
+                    connection.close()
+            self.__idle = {}
+
+
+class Validators(object):
+    """
+    Thread-safe LRU map of URL to (etag, body) of remembered GET responses,
+    holding at most max_bytes of response bodies.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.__items = collections.OrderedDict()
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.__items)
+
+    def get(self, url):
+        with self.__lock:
+            item = self.__items.pop(url, None)
+            if item is not None:
+                self.__items[url] = item
+            return item
+
+    def set(self, url, etag, body):
+        with self.__lock:
+            old = self.__items.pop(url, None)
+            if old is not None:
+                self.size -= len(old[1])
+            if len(body) > self.max_bytes:
+                return
+            self.__items[url] = (etag, body)
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                (_, evicted) = self.__items.popitem(last=False)
+                self.size -= len(evicted[1])
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def connection_pool(api_root, max_per_host=None):
+    """
+    Returns the ConnectionPool shared by every JSONClient of api_root with the
+    same max_per_host (by default ConnectionPool.MAX_PER_HOST).
+    """
+    max_per_host = max_per_host or ConnectionPool.MAX_PER_HOST
+    with _pools_lock:
+        pool = _pools.get((api_root, max_per_host))
+        if pool is None:
+            pool = ConnectionPool(max_per_host)
+            _pools[(api_root, max_per_host)] = pool
+        return pool
+
+
 class Query(object):
     """
     The Query object provides methods to create api search
@@ -42,6 +237,10 @@ class Query(object):
         * fetch: fetch data from the remote API. Fetch returns a list of models, or None when no models are available.
             If the remote API returns a cursor, indicating that more results are available, fetch will store that
             cursor and use it for subsequent calls.
+        * adaptive: let fetch() and iter() grow or shrink the page size between pages to aim for a target
+            response time, instead of using a fixed limit.
+        * iter: iterate over every matching model, one at a time. Pages are fetched in a background
+            thread so that the next page is already on its way while the current one is handled.
 
     Usage:
         client = JSONClient("ModelName", "http://host/rest")
@@ -50,6 +249,12 @@ class Query(object):
         while models:
             # do something with models
             models = query.fetch()  # fetch next batch of models
+
+        for model in client.all().filter("name =", "Fred").iter(100):
+            # do something with model
+
+        for model in client.all().adaptive(target_seconds=0.5):
+            # pages are sized to take about half a second each
     """
     FILTER_METHODS = {
         '=': 'feq_',
@@ -60,11 +265,16 @@ class Query(object):
         '!=': 'fne_'
     }
 
+    # Page sizes never change by more than this factor from one page to the next.
+    ADAPTIVE_STEP = 2.0
+
     def __init__(self, client, querystring=None):
         self.__client = client
         self.__params = []
         self.__data_was_fetched = False
         self.__querystring = querystring
+        self.__adaptive = None
+        self.__limit = None
 
     def filter(self, expression, value):
         """
@@ -105,6 +315,24 @@ class Query(object):
         self.__params.append(('cursor', cursor))
         return self
 
+    def adaptive(self, target_seconds=0.5, min_limit=10, max_limit=1000, target_bytes=None):
+        """
+        Sizes pages adaptively: after each page, the limit for the next one is
+        chosen from the observed time (and, if target_bytes is given, payload size)
+        per model so that pages take about target_seconds (and hold about
+        target_bytes of JSON). The limit stays between min_limit and the smaller
+        of max_limit and the server's advertised max_limit, and changes by at most
+        ADAPTIVE_STEP per page. A limit given to fetch() sets the first page size.
+
+        Returns:
+            self to support method chaining
+        """
+        if self.__data_was_fetched:
+            raise QueryLockedError("Query objects cannot be reused, except to call fetch() multiple times when paging through recordsets.")
+
+        self.__adaptive = (target_seconds, min_limit, max_limit, target_bytes)
+        return self
+
     def fetch(self, limit=None):
         if limit:
             try:
@@ -112,7 +340,11 @@ class Query(object):
             except TypeError:
                 raise ValueError('limit must be an int')
 
-            self.__params.append(('limit', limit))
+            if self.__querystring:
+                self.__querystring = self.__with_argument(self.__querystring, 'limit', limit)
+            else:
+                self.__params.append(('limit', limit))
+            self.__limit = limit
 
         if self.__querystring:
             querystring = self.__querystring
@@ -120,23 +352,105 @@ class Query(object):
             if self.__data_was_fetched:
                 return []
 
+            if self.__adaptive and not self.__limit:
+                self.__limit = self.__adaptive[1]
+                self.__params.append(('limit', self.__limit))
+
             querystring = ''
             for (key, value) in self.__params:
                 if querystring:
                     querystring += "&"
                 querystring += "{0}={1}".format(self.encode(key), self.encode(value))
 
-        (models, cursor, next_page) = self.__client.search(querystring)
+        start = time.time()
+        data = self.__client.search_page(querystring)
+        elapsed = time.time() - start
+        models = data.get('models')
+        cursor = data.get('cursor')
         self.__data_was_fetched = True
         if cursor:
-            querystring = re.sub('cursor=[^?&]+&?', '', querystring)
-            querystring = querystring.rstrip('&')
-            querystring += '&cursor=' + cursor
+            querystring = self.__with_argument(querystring, 'cursor', cursor)
+            if self.__adaptive and models:
+                self.__limit = self.__next_limit(elapsed, models, data.get('max_limit'))
+                querystring = self.__with_argument(querystring, 'limit', self.__limit)
             self.__querystring = querystring
         else:
             self.__querystring = None
         return models
 
+    def __next_limit(self, elapsed, models, server_max_limit):
+        (target_seconds, min_limit, max_limit, target_bytes) = self.__adaptive
+        limit = float(self.__limit or len(models))
+
+        ideal = limit * self.ADAPTIVE_STEP
+        if elapsed > 0:
+            ideal = min(ideal, target_seconds * len(models) / elapsed)
+        if target_bytes:
+            ideal = min(ideal, target_bytes * len(models) / float(len(json.dumps(models)) or 1))
+        ideal = max(ideal, limit / self.ADAPTIVE_STEP)
+
+        if server_max_limit:
+            max_limit = min(max_limit, server_max_limit)
+        return int(max(min_limit, min(max_limit, ideal)))
+
+    @staticmethod
+    def __with_argument(querystring, name, value):
+        """
+        Returns querystring with the argument name set to value, replacing any existing value.
+        """
+        querystring = re.sub('(^|&){0}=[^&]*'.format(re.escape(name)), '', querystring).lstrip('&')
+        if querystring:
+            querystring += '&'
+        return querystring + '{0}={1}'.format(name, value)
+
+    def __iter__(self):
+        return self.iter()
+
+    def iter(self, batch_size=None, prefetch=2):
+        """
+        Generator yielding every model matched by the query, fetching batch_size
+        models per request. Up to prefetch pages are fetched ahead in a
+        background thread while the caller handles the current page.
+
+        The Query must not be used by anything else while it is being iterated.
+        """
+        pages = Queue.Queue(maxsize=prefetch)
+        stopped = threading.Event()
+
+        def put(item):
+            # Returns False once the consumer has gone away.
+            while not stopped.is_set():
+                try:
+                    pages.put(item, timeout=0.1)
+                    return True
+                except Queue.Full:
+                    pass
+            return False
+
+        def produce():
+            try:
+                models = self.fetch(batch_size)
+                while models and put(models):
+                    models = self.fetch()
+                put(None)
+            except Exception as ex:
+                put(ex)
+
+        producer = threading.Thread(target=produce)
+        producer.daemon = True
+        producer.start()
+        try:
+            while True:
+                page = pages.get()
+                if page is None:
+                    return
+                if isinstance(page, Exception):
+                    raise page
+                for model in page:
+                    yield model
+        finally:
+            stopped.set()
+
     def encode(self, s):
         utf8 = unicode(s).encode('utf-8')
         return urllib.quote(utf8)
@@ -145,11 +459,26 @@ class Query(object):
 class JSONClient(object):
     """
     JSONClient provides methods to Create, Read, Update, and Delete individual models from the remote API.
+
+    Responses to read() are remembered along with their ETag, which is sent
+    back as If-None-Match so the server can answer 304 Not Modified instead of
+    sending the same data again. The least recently used responses are
+    forgotten once they add up to more than VALIDATOR_BYTES.
+
+    Requests are made over persistent connections shared by every JSONClient
+    with the same api_root and max_per_host (see ConnectionPool). At most
+    max_per_host requests run at once against the API, however many threads
+    make them, including the *_many methods' threads.
     """
-    def __init__(self, model_name, api_root):
+    # Maximum size of the GET responses remembered for conditional requests.
+    VALIDATOR_BYTES = 1024 * 1024
+
+    def __init__(self, model_name, api_root, max_per_host=None):
         self.headers = {}
         self.model_name = model_name
         self.api_root = api_root
+        self.pool = connection_pool(api_root, max_per_host)
+        self.__validators = Validators(self.VALIDATOR_BYTES)
 
     def authenticate(self):
         """
@@ -174,7 +503,7 @@ class JSONClient(object):
         Parameters:
           id_: Model.key().id()
         """
-        return self.__call_json_api(self.api_url(id_), method='GET')
+        return self.__call_json_api(self.api_url(id_), method='GET', conditional=True)
 
     def update(self, id_, data):
         """
@@ -192,6 +521,62 @@ class JSONClient(object):
         """
         return self.__call_json_api(self.api_url(id_), method='DELETE')
 
+    def create_many(self, items, concurrency=None):
+        """
+        Create a new instance of Model for each dict in items, concurrently.
+        Returns a list, in the order of items, of created models or of the exception raised creating each one.
+        """
+        return self.__map(self.create, items, concurrency)
+
+    def read_many(self, ids, concurrency=None):
+        """
+        Get existing instances of a Model, concurrently.
+        Returns a list, in the order of ids, of models or of the exception (e.g. ObjectMissingError) raised reading each one.
+        """
+        return self.__map(self.read, ids, concurrency)
+
+    def update_many(self, items, concurrency=None):
+        """
+        Update existing instances of a Model, concurrently.
+        Parameters:
+          items: list of (id_, data) pairs
+        Returns a list, in the order of items, of updated models or of the exception raised updating each one.
+        """
+        return self.__map(lambda item: self.update(*item), items, concurrency)
+
+    def delete_many(self, ids, concurrency=None):
+        """
+        Delete existing instances of a Model, concurrently.
+        Returns a list, in the order of ids, of the deleted ids or of the exception raised deleting each one.
+        """
+        return self.__map(self.delete, ids, concurrency)
+
+    def __map(self, func, items, concurrency=None):
+        """
+        Calls func on every item using up to concurrency threads (by default the
+        connection pool's max_per_host). Requests are still limited to
+        max_per_host at a time, so concurrency is capped at it: create the
+        client with a larger max_per_host to run more requests at once.
+        Exceptions are returned in place of results rather than raised.
+        """
+        def call(item):
+            try:
+                return func(item)
+            except Exception as ex:
+                return ex
+
+        items = list(items)
+        if not items:
+            return []
+
+        threads = min(concurrency or self.pool.max_per_host, self.pool.max_per_host, len(items))
+        pool = ThreadPool(threads)
+        try:
+            return pool.map(call, items)
+        finally:
+            pool.close()
+            pool.join()
+
     def all(self):
         """
         Return a Query instance that can be used to search for instances of this Model.
@@ -204,12 +589,20 @@ class JSONClient(object):
 
         It's much easier to use the Query class to deal with the results for you.
         """
-        data = self.__call_json_api(self.api_url("search"), querystring=querystring)
+        data = self.search_page(querystring)
         return data.get('models'), data.get('cursor'), data.get('next_page')
 
-    def __call_json_api(self, api_path, query_params=None, payload_params=None, querystring=None, method='GET'):
+    def search_page(self, querystring):
+        """
+        Returns the search response's data: a dict of models, cursor, next_page and max_limit.
+        """
+        return self.__call_json_api(self.api_url("search"), querystring=querystring)
+
+    def __call_json_api(self, api_path, query_params=None, payload_params=None, querystring=None, method='GET',
+                        conditional=False):
         """
         Low-level method to package up query string, post data, and make the appropriate HTTP REST API call.
+        When conditional is True, the GET response is remembered and revalidated with its ETag.
         """
         self.authenticate()
 
@@ -229,23 +622,29 @@ class JSONClient(object):
 
         headers = {
             'Content-Type': 'application/json, charset=utf-8',
+            'Accept-Encoding': 'gzip',
         }
         headers.update(self.headers)
 
-        request = urllib2.Request(url, data, headers)
-        request.get_method = lambda: method
-        try:
-            response = urllib2.urlopen(request)
-        except urllib2.HTTPError as ex:
-            if ex.code == 403:
-                raise ForbiddenError()
-            if ex.code == 401:
-                raise AuthenticationRequiredError()
-            if ex.code == 404:
-                raise ObjectMissingError()
-            raise
-
-        body = response.read()
+        validator = None
+        if conditional:
+            validator = self.__validators.get(url)
+            if validator:
+                headers['If-None-Match'] = validator[0]
+
+        (status, response_headers, body) = self.pool.request(method, url, data, headers)
+        if status == 304 and validator:
+            return json.loads(validator[1]).get('data')
+        if response_headers.getheader('Content-Encoding') == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        if status == 403:
+            raise ForbiddenError()
+        if status == 401:
+            raise AuthenticationRequiredError()
+        if status == 404:
+            raise ObjectMissingError()
+        if status >= 300:
+            raise ApiCallFailedError('API Call Failed: HTTP {0}: {1}'.format(status, body), status, body)
 
         result = json.loads(body)
         if result.get('status') != 'success':
@@ -254,7 +653,11 @@ class JSONClient(object):
             if result.get('type') == 'AuthenticationFailedError':
                 raise ForbiddenError()
 
-            raise ApiCallFailedError('API Call Failed: ' + str(body))
+            raise ApiCallFailedError('API Call Failed: ' + str(body), status, body)
+
+        etag = response_headers.getheader('ETag')
+        if conditional and etag:
+            self.__validators.set(url, etag, body)
 
         data = result.get('data')
         return data
@@ -283,8 +686,8 @@ class JSONClient(object):
 
 
 class BasicAuthJSONClient(JSONClient):
-    def __init__(self, model_name, api_root, username=None, password=None):
-        super(BasicAuthJSONClient, self).__init__(model_name, api_root)
+    def __init__(self, model_name, api_root, username=None, password=None, max_per_host=None):
+        super(BasicAuthJSONClient, self).__init__(model_name, api_root, max_per_host)
         self.username = username
         self.password = password
 
@@ -29,8 +29,9 @@ class TestSimpleApi(unittest.TestCase):
         Q = Fruit.all()
         fruits = Q.fetch(limit)
         while fruits:
-            for fruit in fruits:
-                Fruit.delete(fruit['id'])
+            for result in Fruit.delete_many([fruit['id'] for fruit in fruits]):
+                if isinstance(result, Exception) and not isinstance(result, ObjectMissingError):
+                    raise result
             fruits = Q.fetch()
 
         fruits = Fruit.all().fetch()
@@ -86,6 +87,23 @@ class TestSimpleApi(unittest.TestCase):
         except ObjectMissingError:
             pass
 
+    def test_bulk(self):
+        Fruit = JSONClient("Fruit", api_root)
+        created = Fruit.create_many([{'name': 'Bulk', 'width': i} for i in range(8)], concurrency=3)
+        self.assertEqual([model['width'] for model in created], range(8))
+
+        ids = [model['id'] for model in created]
+        updated = Fruit.update_many([(id_, {'width': 100}) for id_ in ids])
+        self.assertEqual([model['width'] for model in updated], [100] * 8)
+
+        self.assertEqual(Fruit.delete_many(ids), ids)
+
+        # Errors are reported per item, in order.
+        results = Fruit.read_many(ids[:2])
+        self.assertEqual(len(results), 2)
+        for result in results:
+            self.assertIsInstance(result, ObjectMissingError)
+
     def test_search(self):
         # self.skipTest("Performance")
         name1 = str(uuid.uuid4())
@@ -111,6 +129,11 @@ class TestSimpleApi(unittest.TestCase):
         while models:
             models = Q.fetch()
 
+        # Iterating pages through every model
+        Q = F.all().filter('name =', name1).order('created_datetime', descending=True)
+        widths = [model['width'] for model in Q.iter(2)]
+        self.assertEqual(sorted(widths), range(create_count))
+
         # Clean up
         for model in created_models:
             F.delete(model.get('id'))
@@ -0,0 +1,153 @@
+import BaseHTTPServer
+import SocketServer
+import httplib
+import socket
+import threading
+import time
+import unittest
+from appengine_json_rest.clients.py import ConnectionPool, JSONClient
+
+
+# Unlike the tests in __init__.py, these tests run the client's
+# ConnectionPool against a local in-process HTTP server.
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Answers every request with "ok". One instance serves every request of a
+    keep-alive connection; the server's options decide how reused connections
+    are treated.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.requests = 0
+
+    def log_message(self, format, *args):
+        pass
+
+    def respond(self):
+        server = self.server
+        self.requests += 1
+        with server.lock:
+            server.connections.append(self.client_address)
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+        try:
+            if self.requests > 1 and server.drop_reused:
+                # Close the connection without answering, as a server closing
+                # an idle keep-alive connection just as a request arrives would.
+                self.close_connection = 1
+                return
+            if self.requests > 1 and server.stall_reused:
+                time.sleep(server.stall_reused)
+            time.sleep(server.delay)
+            self.send_response(200)
+            self.send_header('Content-Length', '2')
+            if server.close_after_response:
+                self.send_header('Connection', 'close')
+                self.close_connection = 1
+            self.end_headers()
+            self.wfile.write('ok')
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def do_GET(self):
+        self.respond()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.respond()
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), Handler)
+        self.lock = threading.Lock()
+        self.connections = []
+        self.active = 0
+        self.max_active = 0
+        self.drop_reused = False
+        self.stall_reused = 0
+        self.delay = 0
+        self.close_after_response = False
+
+    def handle_error(self, request, client_address):
+        # Writing to a connection the client gave up on (see test_timeout_not_retried).
+        pass
+
+
+class TestConnectionPool(unittest.TestCase):
+    def setUp(self):
+        self.server = Server()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:{0}/'.format(self.server.server_address[1])
+        self.pool = ConnectionPool(timeout=5)
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_connections_reused(self):
+        for i in range(3):
+            self.assertEqual(self.pool.request('GET', self.url)[::2], (200, 'ok'))
+        self.assertEqual(len(set(self.server.connections)), 1)
+
+    def test_connection_close_not_reused(self):
+        self.server.close_after_response = True
+        for i in range(2):
+            self.assertEqual(self.pool.request('GET', self.url)[0], 200)
+        self.assertEqual(len(set(self.server.connections)), 2)
+
+    def test_closed_connection_retried_for_get(self):
+        self.pool.request('GET', self.url)
+        self.server.drop_reused = True
+        self.assertEqual(self.pool.request('GET', self.url)[::2], (200, 'ok'))
+        self.assertEqual(len(self.server.connections), 3)
+
+    def test_closed_connection_not_retried_for_sent_post(self):
+        self.pool.request('GET', self.url)
+        self.server.drop_reused = True
+        self.assertRaises(httplib.HTTPException, self.pool.request, 'POST', self.url, 'body')
+        self.assertEqual(len(self.server.connections), 2)
+
+    def test_timeout_not_retried(self):
+        self.pool = ConnectionPool(timeout=0.2)
+        self.pool.request('GET', self.url)
+        self.server.stall_reused = 1
+        self.assertRaises(socket.timeout, self.pool.request, 'GET', self.url)
+        self.assertEqual(len(self.server.connections), 2)
+
+    def test_per_host_limit(self):
+        self.server.delay = 0.1
+        self.pool = ConnectionPool(max_per_host=2, timeout=5)
+        threads = [threading.Thread(target=self.pool.request, args=('GET', self.url)) for i in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(self.server.connections), 6)
+        self.assertEqual(self.server.max_active, 2)
+
+    def test_client_concurrency_capped_at_per_host_limit(self):
+        self.server.delay = 0.1
+        client = JSONClient('Fruit', self.url, max_per_host=3)
+        self.assertEqual(client.pool.max_per_host, 3)
+        self.assertFalse(client.pool is JSONClient('Fruit', self.url).pool)
+        try:
+            client.read_many(range(1, 10), concurrency=8)
+        finally:
+            client.pool.close()
+        self.assertEqual(len(self.server.connections), 9)
+        self.assertEqual(self.server.max_active, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,704 @@
+import contextlib
+import json
+import time
+import unittest
+import urlparse
+import zlib
+import webapp2
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.ext import db
+from google.appengine.ext import testbed
+from appengine_json_rest.appengine_json_rest.application import JSONApplication
+from appengine_json_rest.appengine_json_rest.cache import AuthCache, FragmentCache, LRUCache, QueryCache
+from appengine_json_rest.appengine_json_rest import cache as cache_module
+from appengine_json_rest.appengine_json_rest import errors
+from appengine_json_rest.appengine_json_rest import jsoncodec
+from appengine_json_rest.appengine_json_rest.profiling import ProfilePolicy
+from appengine_json_rest.appengine_json_rest.timing import RequestTimer, TimingStats
+
+
+# Unlike the tests in __init__.py, these tests run the API in-process
+# against the App Engine SDK's in-memory datastore stub.
+
+
+class Basket(db.Model):
+    location = db.GeoPtProperty()
+
+
+class Fruit(db.Model):
+    name = db.StringProperty()
+    width = db.IntegerProperty()
+    basket = db.ReferenceProperty(Basket, collection_name='fruits')
+    previous_basket = db.ReferenceProperty(Basket, collection_name='previous_fruits')
+
+
+@contextlib.contextmanager
+def cache_clock(offset):
+    """Moves the clock cache.LRUCache expires values by offset seconds ahead."""
+    class Clock(object):
+        @staticmethod
+        def time():
+            return time.time() + offset
+
+    cache_module.time = Clock
+    try:
+        yield
+    finally:
+        cache_module.time = time
+
+
+class RpcCounter(object):
+    """APIProxy pre-call hook recording the datastore RPCs made while it is installed."""
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, service, call, request, response):
+        self.calls.append(call)
+
+    def count(self, call):
+        return self.calls.count(call)
+
+    def reset(self):
+        self.calls = []
+
+
+class ServerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        self.rpcs = RpcCounter()
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('rpc_counter', self.rpcs, 'datastore_v3')
+        self.app = self.create_application()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def create_application(self):
+        return JSONApplication('rest', models=[Basket, Fruit])
+
+    def call(self, path, method='GET', body=None, headers=None):
+        request = webapp2.Request.blank(path, headers=headers)
+        request.method = method
+        if body is not None:
+            request.body = body
+        return request.get_response(self.app)
+
+    def call_json(self, path, method='GET', body=None, headers=None):
+        response = self.call(path, method, body, headers)
+        return json.loads(response.body)
+
+    def create_fruits(self, count):
+        baskets = [Basket(), Basket(), Basket()]
+        db.put(baskets)
+        fruits = []
+        for i in range(count):
+            fruits.append(Fruit(name='fruit{0}'.format(i), width=i,
+                                basket=baskets[i % 3], previous_basket=baskets[(i + 1) % 3]))
+        db.put(fruits)
+        return fruits
+
+
+class TestSearchRpcs(ServerTestCase):
+    def test_references_rendered_without_fetch(self):
+        self.create_fruits(30)
+        self.rpcs.reset()
+
+        result = self.call_json('/rest/Fruit/search?limit=30')
+
+        self.assertEqual(len(result['data']['models']), 30)
+        self.assertEqual(self.rpcs.count('Get'), 0)
+        for model in result['data']['models']:
+            self.assertEqual(model['basket']['model'], 'Basket')
+            self.assertEqual(model['previous_basket']['model'], 'Basket')
+            self.assertFalse('data' in model['basket'])
+
+    def test_expanded_references_fetched_once_per_page(self):
+        self.create_fruits(30)
+        self.rpcs.reset()
+
+        result = self.call_json('/rest/Fruit/search?limit=30&expand=basket')
+
+        self.assertEqual(len(result['data']['models']), 30)
+        self.assertEqual(self.rpcs.count('Get'), 1)
+        for model in result['data']['models']:
+            self.assertTrue('location' in model['basket']['data'])
+            self.assertFalse('data' in model['previous_basket'])
+        self.assertTrue('expand=basket' in result['data']['next_page'])
+
+
+class TestReferenceSearch(ServerTestCase):
+    def test_ref_filter(self):
+        fruits = self.create_fruits(6)
+        basket_id = fruits[0].basket.key().id()
+        data = self.call_json('/rest/Fruit/search?ref_basket={0}'.format(basket_id))['data']
+        self.assertEqual(sorted(model['name'] for model in data['models']), ['fruit0', 'fruit3'])
+
+    def test_missing_ref(self):
+        self.create_fruits(3)
+        response = self.call('/rest/Fruit/search?ref_basket=999999')
+        self.assertEqual(response.status_int, 404)
+        self.assertEqual(json.loads(response.body)['type'], 'ObjectMissingError')
+
+
+class TestConditionalGet(ServerTestCase):
+    def test_if_none_match(self):
+        fruit = self.create_fruits(1)[0]
+        url = '/rest/Fruit/{0}'.format(fruit.key().id())
+        etag = self.call(url).headers['ETag']
+
+        response = self.call(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_int, 304)
+        self.assertEqual(response.body, '')
+
+        self.call(url, method='PUT', body=json.dumps({'width': 42}))
+        response = self.call(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_int, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_metadata_if_none_match(self):
+        etag = self.call('/rest/metadata').headers['ETag']
+        self.assertEqual(self.call('/rest/metadata', headers={'If-None-Match': etag}).status_int, 304)
+
+
+class Stamped(db.Model):
+    name = db.StringProperty()
+    stamp = db.StringProperty()
+
+    def put(self, **kwargs):
+        self.stamp = 'stamped'
+        return super(Stamped, self).put(**kwargs)
+
+
+class TestPutOverride(ServerTestCase):
+    def create_application(self):
+        return JSONApplication('rest', models=[Basket, Fruit, Stamped])
+
+    def test_single_model_writes_use_model_put(self):
+        created = self.call_json('/rest/Stamped', 'POST', json.dumps({'name': 'a'}))['data']
+        self.assertEqual(created['stamp'], 'stamped')
+
+        stamped = Stamped(name='b')
+        db.put(stamped)
+        updated = self.call_json('/rest/Stamped/{0}'.format(stamped.key().id()), 'PUT', json.dumps({'name': 'c'}))['data']
+        self.assertEqual(updated['stamp'], 'stamped')
+
+    def test_batch_writes_do_not_depend_on_size(self):
+        for count in (1, 2):
+            items = [{'name': str(i)} for i in range(count)]
+            created = self.call_json('/rest/Stamped/batch', 'POST', json.dumps(items))['data']
+            self.assertEqual([item['data']['stamp'] for item in created], [None] * count)
+
+
+class TestModelPlans(ServerTestCase):
+    def test_registering_converter_rebuilds_plans(self):
+        from appengine_json_rest.appengine_json_rest import converter
+        fruit = self.create_fruits(1)[0]
+        path = '/rest/Fruit/{0}'.format(fruit.key().id())
+        self.assertEqual(self.call_json(path)['data']['name'], 'fruit0')
+        plan = self.app.converter.plan(Fruit)
+
+        original = converter.property_converters.get(db.StringProperty)
+        converter.register_property_converter(db.StringProperty, lambda value: value.upper(), converter.identity)
+        try:
+            self.assertFalse(self.app.converter.plan(Fruit) is plan)
+            self.assertEqual(self.call_json(path)['data']['name'], 'FRUIT0')
+        finally:
+            if original:
+                converter.register_property_converter(db.StringProperty, *original)
+            else:
+                del converter.property_converters[db.StringProperty]
+                converter.converters_generation += 1
+
+
+class TestMetadata(ServerTestCase):
+    def test_metadata_documents_reused(self):
+        first = self.call('/rest/metadata/Fruit')
+        second = self.call('/rest/metadata/Fruit')
+        self.assertEqual(first.body, second.body)
+        self.assertEqual(first.headers['ETag'], second.headers['ETag'])
+        self.assertEqual(sorted(json.loads(first.body)['data'].keys()), ['basket', 'name', 'previous_basket', 'width'])
+
+    def test_model_list_updated_on_registration(self):
+        names = [model['name'] for model in self.call_json('/rest/metadata')['data']]
+        self.assertEqual(sorted(names), ['Basket', 'Fruit'])
+
+        class Crate(db.Model):
+            size = db.IntegerProperty()
+        self.app.register_model(Crate)
+        names = [model['name'] for model in self.call_json('/rest/metadata')['data']]
+        self.assertEqual(sorted(names), ['Basket', 'Crate', 'Fruit'])
+
+
+class TestBatch(ServerTestCase):
+    def test_create_read_update(self):
+        items = [{'name': 'apple', 'width': 1}, {'name': 'pear', 'width': 'wide'}, {'name': 'plum', 'width': 3}]
+        self.rpcs.reset()
+        created = self.call_json('/rest/Fruit/batch', method='POST', body=json.dumps(items))['data']
+        self.assertEqual(self.rpcs.count('Put'), 1)
+        self.assertEqual([item['status'] for item in created], ['success', 'error', 'success'])
+
+        ids = [created[0]['data']['id'], created[2]['data']['id'], 999999]
+        self.rpcs.reset()
+        read = self.call_json('/rest/Fruit/batch?ids={0}'.format(','.join(str(id_) for id_ in ids)))['data']
+        self.assertEqual(self.rpcs.count('Get'), 1)
+        self.assertEqual([item['status'] for item in read], ['success', 'success', 'error'])
+        self.assertEqual(read[2]['type'], 'ObjectMissingError')
+
+        updates = [{'id': ids[0], 'width': 10}, {'id': ids[1], 'width': 30}]
+        self.rpcs.reset()
+        updated = self.call_json('/rest/Fruit/batch', method='PUT', body=json.dumps(updates))['data']
+        self.assertEqual(self.rpcs.count('Put'), 1)
+        self.assertEqual([item['data']['width'] for item in updated], [10, 30])
+
+
+class TestDelete(ServerTestCase):
+    def test_delete_does_not_read(self):
+        fruits = self.create_fruits(3)
+        self.rpcs.reset()
+        result = self.call_json('/rest/Fruit/{0}'.format(fruits[0].key().id()), method='DELETE')
+        self.assertEqual(result['data'], fruits[0].key().id())
+        self.assertEqual(self.rpcs.count('Get'), 0)
+        self.assertEqual(self.rpcs.count('Delete'), 1)
+        self.assertEqual(Fruit.get_by_id(fruits[0].key().id()), None)
+
+    def test_delete_verify_missing(self):
+        response = self.call('/rest/Fruit/999999?verify=1', method='DELETE')
+        self.assertEqual(response.status_int, 404)
+
+    def test_read_invalid_id(self):
+        for id_ in ('0', '-3'):
+            response = self.call('/rest/Fruit/' + id_)
+            self.assertEqual(response.status_int, 404)
+            self.assertEqual(json.loads(response.body)['type'], 'ObjectMissingError')
+
+    def test_delete_many(self):
+        fruits = self.create_fruits(5)
+        ids = [fruit.key().id() for fruit in fruits]
+        self.rpcs.reset()
+        result = self.call_json('/rest/Fruit?ids={0}'.format(','.join(str(id_) for id_ in ids)), method='DELETE')
+        self.assertEqual(result['data'], ids)
+        self.assertEqual(self.rpcs.count('Delete'), 1)
+        self.assertEqual(Fruit.all().count(), 0)
+
+
+class TestFragmentCache(ServerTestCase):
+    def create_application(self):
+        self.cache = FragmentCache(LRUCache())
+        return JSONApplication('rest', models=[Basket, Fruit], fragment_cache=self.cache)
+
+    def test_read_served_from_cache_until_updated(self):
+        fruit = self.create_fruits(1)[0]
+        url = '/rest/Fruit/{0}'.format(fruit.key().id())
+        first = self.call_json(url)
+        self.rpcs.reset()
+        second = self.call_json(url)
+        self.assertEqual(first, second)
+        self.assertEqual(self.rpcs.count('Get'), 0)
+        self.assertEqual(self.cache.stats(), {'hits': 1, 'misses': 1})
+
+        self.call_json(url, method='PUT', body=json.dumps({'width': 42}))
+        self.assertEqual(self.call_json(url)['data']['width'], 42)
+
+    def test_not_modified_without_loading(self):
+        fruit = self.create_fruits(1)[0]
+        url = '/rest/Fruit/{0}'.format(fruit.key().id())
+        etag = self.call(url).headers['ETag']
+        self.rpcs.reset()
+        self.assertEqual(self.call(url, headers={'If-None-Match': etag}).status_int, 304)
+        self.assertEqual(self.rpcs.calls, [])
+
+    def test_search_page_assembled_from_fragments(self):
+        self.create_fruits(5)
+        uncached = self.call_json('/rest/Fruit/search?limit=5&pretty=1')
+        self.call_json('/rest/Fruit/search?limit=5')
+        cached = self.call_json('/rest/Fruit/search?limit=5')
+        self.assertEqual(uncached, cached)
+
+    def test_search_served_from_cache_until_updated(self):
+        fruits = self.create_fruits(3)
+        self.call_json('/rest/Fruit/search?order=width')
+        self.rpcs.reset()
+        models = self.call_json('/rest/Fruit/search?order=width')['data']['models']
+        self.assertEqual([model['width'] for model in models], [0, 1, 2])
+        self.assertEqual(self.rpcs.count('Get'), 0)
+        self.assertEqual(self.cache.stats(), {'hits': 3, 'misses': 3})
+
+        self.call_json('/rest/Fruit/{0}'.format(fruits[0].key().id()), method='PUT', body=json.dumps({'width': 42}))
+        models = self.call_json('/rest/Fruit/search?order=width')['data']['models']
+        self.assertEqual([model['width'] for model in models], [1, 2, 42])
+
+    def test_search_serves_fragments_until_they_expire(self):
+        fruit = self.create_fruits(1)[0]
+        self.call_json('/rest/Fruit/search')
+
+        # Written outside the API, so the fragment is not invalidated.
+        fruit.width = 99
+        fruit.put()
+        self.assertEqual(self.call_json('/rest/Fruit/search')['data']['models'][0]['width'], 0)
+        with cache_clock(self.cache.time + 1):
+            self.assertEqual(self.call_json('/rest/Fruit/search')['data']['models'][0]['width'], 99)
+
+    def test_validator_changes_when_fragment_expires(self):
+        fruit = self.create_fruits(1)[0]
+        url = '/rest/Fruit/{0}'.format(fruit.key().id())
+        etag = self.call(url).headers['ETag']
+
+        # Written outside the API, so the fragment is not invalidated.
+        fruit.width = 99
+        fruit.put()
+        self.assertEqual(self.call(url, headers={'If-None-Match': etag}).status_int, 304)
+
+        with cache_clock(self.cache.time + 1):
+            response = self.call(url, headers={'If-None-Match': etag})
+            self.assertEqual(response.status_int, 200)
+            self.assertNotEqual(response.headers['ETag'], etag)
+            self.assertEqual(json.loads(response.body)['data']['width'], 99)
+
+            etag = response.headers['ETag']
+            fruit.delete()
+            self.assertEqual(self.call(url, headers={'If-None-Match': etag}).status_int, 304)
+        with cache_clock(2 * self.cache.time + 2):
+            self.assertEqual(self.call(url, headers={'If-None-Match': etag}).status_int, 404)
+
+
+class TestExport(ServerTestCase):
+    def export(self, querystring):
+        lines = self.call('/rest/Fruit/export?' + querystring).body.splitlines()
+        return [json.loads(line) for line in lines[:-1]], json.loads(lines[-1])
+
+    def test_export_everything(self):
+        self.create_fruits(25)
+        models, trailer = self.export('batch_size=10')
+        self.assertEqual(len(models), 25)
+        self.assertEqual(trailer, {'cursor': None, 'count': 25})
+
+    def test_export_resumes_from_cursor(self):
+        self.create_fruits(25)
+        first, trailer = self.export('limit=10&order=width')
+        self.assertEqual(trailer['count'], 10)
+        rest, trailer = self.export('order=width&cursor=' + trailer['cursor'])
+        self.assertEqual([model['width'] for model in first + rest], range(25))
+
+    def test_export_fields(self):
+        self.create_fruits(3)
+        models, trailer = self.export('fields=name,width&order=width')
+        self.assertEqual([(model['name'], model['width']) for model in models],
+                         [('fruit0', 0), ('fruit1', 1), ('fruit2', 2)])
+        for model in models:
+            self.assertEqual(sorted(model.keys()), ['id', 'key', 'name', 'width'])
+
+
+class TestFields(ServerTestCase):
+    def test_search_fields(self):
+        self.create_fruits(3)
+        models = self.call_json('/rest/Fruit/search?fields=name&order=name')['data']['models']
+        self.assertEqual([model['name'] for model in models], ['fruit0', 'fruit1', 'fruit2'])
+        for model in models:
+            self.assertEqual(sorted(model.keys()), ['id', 'key', 'name'])
+
+    def test_read_fields(self):
+        fruit = self.create_fruits(1)[0]
+        model = self.call_json('/rest/Fruit/{0}?fields=width,basket'.format(fruit.key().id()))['data']
+        self.assertEqual(sorted(model.keys()), ['basket', 'id', 'key', 'width'])
+
+
+class TestKeysOnly(ServerTestCase):
+    def test_keys_only_search(self):
+        fruits = self.create_fruits(5)
+        self.rpcs.reset()
+        data = self.call_json('/rest/Fruit/search?keys_only=1&limit=3')['data']
+        self.assertEqual(self.rpcs.count('Get'), 0)
+        self.assertEqual(len(data['models']), 3)
+        self.assertTrue('keys_only=1' in data['next_page'])
+        ids = set(fruit.key().id() for fruit in fruits)
+        for model in data['models']:
+            self.assertEqual(sorted(model.keys()), ['id', 'key'])
+            self.assertTrue(model['id'] in ids)
+
+
+class TestPageSize(ServerTestCase):
+    def create_application(self):
+        return JSONApplication('rest', models=[Basket, Fruit], max_page_size=4)
+
+    def test_limit_reduced_to_max_page_size(self):
+        self.create_fruits(6)
+        data = self.call_json('/rest/Fruit/search?limit=10')['data']
+        self.assertEqual(data['max_limit'], 4)
+        self.assertEqual(len(data['models']), 4)
+        self.assertTrue(data['cursor'])
+
+
+class TestTiming(ServerTestCase):
+    def create_application(self):
+        return JSONApplication('rest', models=[Basket, Fruit], timing=True)
+
+    def test_server_timing_and_stats(self):
+        self.create_fruits(5)
+        response = self.call('/rest/Fruit/search?limit=5')
+        phases = [entry.split(';')[0] for entry in response.headers['Server-Timing'].split(', ')]
+        for phase in ('datastore', 'convert', 'encode', 'total'):
+            self.assertTrue(phase in phases)
+
+        stats = self.call_json('/rest/_stats')['data']
+        search = [item for item in stats if item['route'] == 'GET SearchHandler']
+        self.assertEqual(len(search), 1)
+        self.assertEqual(search[0]['model'], 'Fruit')
+        self.assertEqual(search[0]['count'], 1)
+        self.assertTrue(search[0]['mean_rpcs'] >= 1)
+
+    def test_export_timed_until_streamed(self):
+        self.create_fruits(5)
+        response = self.call('/rest/Fruit/export')
+        self.assertEqual(len(response.body.splitlines()), 6)
+        self.assertFalse('Server-Timing' in response.headers)
+
+        stats = self.call_json('/rest/_stats')['data']
+        export = [item for item in stats if item['route'] == 'GET ExportHandler']
+        self.assertEqual(len(export), 1)
+        self.assertEqual(export[0]['model'], 'Fruit')
+        self.assertTrue(export[0]['mean_rpcs'] >= 1)
+        self.assertTrue('convert' in export[0]['mean_phase_ms'])
+
+    def test_unregistered_models_share_stats(self):
+        for name in ('Missing1', 'Missing2', 'Missing3'):
+            self.call('/rest/{0}/search'.format(name))
+        stats = self.call_json('/rest/_stats')['data']
+        search = [item for item in stats if item['route'] == 'GET SearchHandler']
+        self.assertEqual(len(search), 1)
+        self.assertEqual(search[0]['model'], None)
+        self.assertEqual(search[0]['count'], 3)
+
+    def test_stats_keys_capped(self):
+        stats = TimingStats(max_keys=2)
+        timer = RequestTimer()
+        timer.stop()
+        for route in ('a', 'b', 'c', 'd'):
+            stats.record(route, None, timer)
+        routes = dict((item['route'], item['count']) for item in stats.snapshot())
+        self.assertEqual(routes, {'a': 1, 'b': 1, TimingStats.OVERFLOW_ROUTE: 2})
+
+    def test_disabled_by_default(self):
+        self.app = JSONApplication('rest', models=[Basket, Fruit])
+        self.assertFalse('Server-Timing' in self.call('/rest/metadata').headers)
+        self.assertEqual(self.call('/rest/_stats').status_int, 404)
+
+
+class TestProfiling(ServerTestCase):
+    def create_application(self):
+        policy = ProfilePolicy(allow_param=True, top=5, attach=True)
+        return JSONApplication('rest', models=[Basket, Fruit], profile_policy=policy)
+
+    def test_profile_param(self):
+        fruit = self.create_fruits(1)[0]
+        self.assertFalse('X-Profile' in self.call('/rest/Fruit/{0}'.format(fruit.key().id())).headers)
+
+        response = self.call('/rest/Fruit/{0}?_profile=1'.format(fruit.key().id()))
+        self.assertEqual(json.loads(response.body)['data']['name'], 'fruit0')
+        report = json.loads(response.headers['X-Profile'])
+        self.assertEqual(report['status'], 200)
+        self.assertEqual(len(report['top']), 5)
+        self.assertTrue(all('cumulative_ms' in row for row in report['top']))
+
+    def test_profile_param_requires_authentication(self):
+        def auth_func(request):
+            raise errors.ForbiddenError()
+
+        self.app = JSONApplication('rest', models=[Basket, Fruit], auth_func=auth_func,
+                                   profile_policy=ProfilePolicy(allow_param=True, attach=True))
+        response = self.call('/rest/metadata?_profile=1')
+        self.assertEqual(response.status_int, 403)
+        self.assertFalse('X-Profile' in response.headers)
+
+
+class TestSearchBudget(ServerTestCase):
+    def test_partial_pages_resume_at_cursor(self):
+        self.create_fruits(120)
+        data = self.call_json('/rest/Fruit/search?limit=100&budget=0.000001')['data']
+        self.assertTrue(data['partial'])
+        self.assertEqual(len(data['models']), 50)
+        self.assertTrue('budget=' in data['next_page'])
+
+        names = [model['name'] for model in data['models']]
+        while data['cursor']:
+            data = self.call_json('/rest/Fruit/search?limit=100&budget=0.000001&cursor=' + data['cursor'])['data']
+            names += [model['name'] for model in data['models']]
+        self.assertEqual(sorted(names), sorted('fruit{0}'.format(i) for i in range(120)))
+
+    def test_complete_page_within_budget(self):
+        self.create_fruits(10)
+        data = self.call_json('/rest/Fruit/search?limit=20&budget=60')['data']
+        self.assertFalse(data['partial'])
+        self.assertEqual(len(data['models']), 10)
+        self.assertEqual(data['cursor'], None)
+
+
+class TestQueryCache(ServerTestCase):
+    def create_application(self):
+        self.query_cache = QueryCache(LRUCache())
+        return JSONApplication('rest', models=[Basket, Fruit], query_cache=self.query_cache)
+
+    def test_pages_cached_until_model_changes(self):
+        self.create_fruits(5)
+        first = self.call_json('/rest/Fruit/search?limit=3&order=width')['data']
+        self.rpcs.reset()
+
+        # Same search, arguments in a different order.
+        second = self.call_json('/rest/Fruit/search?order=width&limit=3')['data']
+        self.assertEqual(self.rpcs.count('RunQuery'), 0)
+        self.assertEqual(self.rpcs.count('Get'), 1)
+        self.assertEqual(second['models'], first['models'])
+        self.assertEqual(second['cursor'], first['cursor'])
+        self.assertEqual(urlparse.parse_qs(urlparse.urlsplit(second['next_page']).query),
+                         urlparse.parse_qs(urlparse.urlsplit(first['next_page']).query))
+        self.assertEqual(self.query_cache.stats(), {'hits': 1, 'misses': 1})
+
+        self.call('/rest/Fruit', 'POST', json.dumps({'name': 'first', 'width': -1}))
+        third = self.call_json('/rest/Fruit/search?limit=3&order=width')['data']
+        self.assertEqual(third['models'][0]['name'], 'first')
+
+    def test_next_page_built_for_each_request(self):
+        self.create_fruits(5)
+        self.call_json('/rest/Fruit/search?limit=3&expand=basket&budget=10')
+        data = self.call_json('/rest/Fruit/search?limit=3')['data']
+        self.assertEqual(self.query_cache.stats(), {'hits': 1, 'misses': 1})
+        self.assertFalse('expand=' in data['next_page'])
+        self.assertFalse('budget=' in data['next_page'])
+        self.assertTrue('cursor=' in data['next_page'])
+
+    def test_keys_only_and_ref_pages(self):
+        fruits = self.create_fruits(4)
+        path = '/rest/Fruit/search?keys_only=1&ref_basket={0}'.format(fruits[0].basket.key().id())
+        first = self.call_json(path)['data']
+        self.rpcs.reset()
+        self.assertEqual(self.call_json(path)['data']['models'], first['models'])
+        self.assertEqual(len(self.rpcs.calls), 0)
+
+        # Deleting the referenced Basket invalidates pages that depend on it.
+        self.call('/rest/Basket/{0}'.format(fruits[0].basket.key().id()), 'DELETE')
+        self.assertEqual(self.call(path).status_int, 404)
+
+    def test_pages_expire(self):
+        self.create_fruits(2)
+        self.call_json('/rest/Fruit/search?order=width')
+
+        # Written outside the API, so cached pages are not invalidated.
+        self.create_fruits(1)
+        self.assertEqual(len(self.call_json('/rest/Fruit/search?order=width')['data']['models']), 2)
+        with cache_clock(self.query_cache.time + 1):
+            self.assertEqual(len(self.call_json('/rest/Fruit/search?order=width')['data']['models']), 3)
+
+    def test_no_pages_stored_while_writes_settle(self):
+        self.call('/rest/Fruit', 'POST', json.dumps({'name': 'apple', 'width': 1}))
+        self.call_json('/rest/Fruit/search')
+        self.call_json('/rest/Fruit/search')
+        self.assertEqual(self.query_cache.stats(), {'hits': 0, 'misses': 2})
+
+        with cache_clock(self.query_cache.settle + 1):
+            self.call_json('/rest/Fruit/search')
+            self.call_json('/rest/Fruit/search')
+        self.assertEqual(self.query_cache.stats(), {'hits': 1, 'misses': 3})
+
+
+class TestDateParsing(unittest.TestCase):
+    def test_fast_path_matches_dateutil(self):
+        from dateutil import parser as date_parser
+        from appengine_json_rest.appengine_json_rest import converter
+        for s in ['2012-01-03T15:32:00', '2012-01-03 15:32:00.25', '2012-01-03', '2012-01-03T15:32']:
+            self.assertEqual(converter.parse_iso_datetime(s), date_parser.parse(s))
+        self.assertEqual(converter.to_time('15:32:07.5'), date_parser.parse('15:32:07.5').time())
+
+    def test_fallback(self):
+        from appengine_json_rest.appengine_json_rest import converter
+        self.assertEqual(converter.parse_iso_datetime('Jan 3 2012'), None)
+        self.assertEqual(converter.to_date('Jan 3 2012').isoformat(), '2012-01-03')
+
+
+class RecordingCodec(jsoncodec.StdlibCodec):
+    name = 'recording'
+
+    def __init__(self):
+        self.decoded = []
+
+    def loads(self, s):
+        self.decoded.append(s)
+        return super(RecordingCodec, self).loads(s)
+
+
+class TestCodecs(ServerTestCase):
+    def test_codecs_match_stdlib(self):
+        fruits = self.create_fruits(5)
+        self.app.set_globals(app=self.app, request=webapp2.Request.blank('/'))
+        try:
+            page = {'models': [self.app.converter.read_model(fruit) for fruit in fruits], 'cursor': None}
+        finally:
+            self.app.clear_globals()
+
+        expected = json.loads(json.dumps(page))
+        for codec in jsoncodec.available_codecs():
+            self.assertEqual(codec.loads(codec.dumps(page)), expected, codec.name)
+            self.assertEqual(json.loads(codec.dumps(page)), expected, codec.name)
+            self.assertEqual(json.loads(codec.dumps(page, indent=4)), expected, codec.name)
+
+    def test_request_bodies_decoded_by_application_codec(self):
+        codec = RecordingCodec()
+        self.app = JSONApplication('rest', models=[Basket, Fruit], json_codec=codec)
+        created = self.call_json('/rest/Fruit', 'POST', json.dumps({'name': 'apple', 'width': 1}))['data']
+        updated = self.call_json('/rest/Fruit/{0}'.format(created['id']), 'PUT', json.dumps({'width': 2}))['data']
+        self.assertEqual(updated['width'], 2)
+        self.assertEqual(len(codec.decoded), 2)
+
+
+class TestGzip(ServerTestCase):
+    def create_application(self):
+        return JSONApplication('rest', models=[Basket, Fruit], gzip_level=6, gzip_min_size=100)
+
+    def test_search_gzipped_when_accepted(self):
+        self.create_fruits(10)
+        plain = self.call('/rest/Fruit/search')
+        self.assertFalse('Content-Encoding' in plain.headers)
+
+        gzipped = self.call('/rest/Fruit/search', headers={'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(gzipped.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(zlib.decompress(gzipped.body, 16 + zlib.MAX_WBITS), plain.body)
+        self.assertNotEqual(gzipped.headers['ETag'], plain.headers['ETag'])
+
+    def test_export_gzipped(self):
+        self.create_fruits(10)
+        plain = self.call('/rest/Fruit/export')
+        gzipped = self.call('/rest/Fruit/export', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(zlib.decompress(gzipped.body, 16 + zlib.MAX_WBITS), plain.body)
+
+    def test_small_responses_not_gzipped(self):
+        response = self.call('/rest/Fruit/999999', method='DELETE', headers={'Accept-Encoding': 'gzip'})
+        self.assertFalse('Content-Encoding' in response.headers)
+
+
+class TestAuthCache(ServerTestCase):
+    def create_application(self):
+        self.auth_calls = []
+        self.auth_cache = AuthCache(ttl=60, negative_ttl=60)
+
+        def auth_func(request):
+            self.auth_calls.append(request.headers.get('Authorization'))
+            if request.headers.get('Authorization') != 'Basic good':
+                raise errors.ForbiddenError()
+
+        return JSONApplication('rest', models=[Basket, Fruit], auth_func=auth_func, auth_cache=self.auth_cache)
+
+    def test_decisions_cached(self):
+        for _ in range(3):
+            self.assertEqual(self.call('/rest/metadata', headers={'Authorization': 'Basic good'}).status_int, 200)
+            self.assertEqual(self.call('/rest/metadata', headers={'Authorization': 'Basic bad'}).status_int, 403)
+        self.assertEqual(self.auth_calls, ['Basic good', 'Basic bad'])
+
+        self.auth_cache.invalidate()
+        self.call('/rest/metadata', headers={'Authorization': 'Basic good'})
+        self.assertEqual(len(self.auth_calls), 3)
+
+    def test_requests_without_credentials_not_cached(self):
+        for _ in range(3):
+            self.assertEqual(self.call('/rest/metadata').status_int, 403)
+        self.assertEqual(self.auth_calls, [None, None, None])
+        self.assertEqual(self.auth_cache.stats(), {'hits': 0, 'misses': 0})